@@ -1,33 +1,271 @@
+import asyncio
+import gzip
+import os
+import signal
+
 import click
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 import widgets.auth
+import widgets.changes
 import widgets.database
+import widgets.maintenance
+import widgets.metrics
 import widgets.migrations
+import widgets.profiling
+import widgets.transfer
 import widgets.widgets
 
 
-@click.command()
+async def startup(dbmanager, migrate=True):
+    await dbmanager.open()
+    if migrate:
+        await widgets.migrations.run_migrations(dbmanager)
+    await dbmanager.prefetch_alphabets(["account", "widget"])
+
+
+async def migrate(database, storage, shards):
+    dbmanager = widgets.database.ConnectionManager(
+        database, None, storage=storage, shards=shards)
+    try:
+        await dbmanager.open()
+        await widgets.migrations.run_migrations(dbmanager)
+    finally:
+        await dbmanager.close()
+
+
+def run_command(database, shards, command, *args):
+    # Runs one of the data transfer commands on its own event loop.
+    dbmanager = widgets.database.ConnectionManager(
+        database, None, shards=shards)
+
+    async def main():
+        await dbmanager.open()
+        try:
+            return await command(dbmanager, *args)
+        finally:
+            await dbmanager.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    except widgets.transfer.TransferError as error:
+        raise click.ClickException(str(error))
+    finally:
+        loop.close()
+
+
+database_option = click.option(
+    '--database',
+    default="database.sqlite",
+    type=click.Path(dir_okay=False, resolve_path=True, writable=True))
+shards_option = click.option(
+    '--shards', default=1, type=click.IntRange(min=1),
+    help="Number of databases to spread accounts' widgets over.")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
 @click.option('--port', default=8888, type=int)
-@click.option('--database',
-              default="database.sqlite",
-              type=click.Path(dir_okay=False,
-                              resolve_path=True,
-                              writable=True))
-def run(port: int, database: str):
+@database_option
+@click.option('--storage', default="sqlite",
+              type=click.Choice(sorted(widgets.database.storage_engines)),
+              help="Where to keep the data.")
+@shards_option
+@click.option('--pool-size', default=4, type=click.IntRange(min=1),
+              help="Number of pooled read connections.")
+@click.option('--token-cache-size', default=4096, type=click.IntRange(min=1),
+              help="Number of auth tokens to remember.")
+@click.option('--token-ttl', default=60.0, type=float,
+              help="Seconds to trust a remembered auth token.")
+@click.option('--commit-delay', default=0.002, type=float,
+              help="Seconds to gather writes before committing them.")
+@click.option('--workers', default=1, type=click.IntRange(min=0),
+              help="Number of server processes, or 0 for one per CPU.")
+@click.option('--listing-cache-bytes', default=0, type=click.IntRange(min=0),
+              help="Memory for caching widget listings, in bytes.")
+@click.option('--retention-days', default=30.0,
+              type=click.FloatRange(min=0),
+              help="Days to keep deleted widgets before purging them.")
+@click.option('--maintenance-interval', default=3600.0,
+              type=click.FloatRange(min=0),
+              help="Seconds between maintenance runs, or 0 for none.")
+@click.option('--max-reads', default=64, type=click.IntRange(min=1),
+              help="Number of requests that may read at once.")
+@click.option('--max-writes', default=16, type=click.IntRange(min=1),
+              help="Number of requests that may write at once.")
+@click.option('--max-queue', default=256, type=click.IntRange(min=0),
+              help="Number of requests of each kind that may wait.")
+@click.option('--queue-timeout', default=5.0, type=click.FloatRange(min=0),
+              help="Seconds a request may wait before getting a 503.")
+@click.option('--profile-dir', default=None,
+              type=click.Path(file_okay=False, resolve_path=True,
+                              writable=True),
+              help="Where to write request profiles; none without it.")
+@click.option('--profile-rate', default=0.01,
+              type=click.FloatRange(min=0, max=1),
+              help="Fraction of requests to profile.")
+@click.option('--profile-secret', default=None,
+              envvar="WIDGETS_PROFILE_SECRET",
+              help="Header value that asks to profile a request.")
+@click.option('--profile-interval', default=60.0,
+              type=click.FloatRange(min=1),
+              help="Seconds between writing out request profiles.")
+def run(port: int, database: str, storage: str, shards: int, pool_size: int,
+        token_cache_size: int, token_ttl: float, commit_delay: float,
+        workers: int, listing_cache_bytes: int, retention_days: float,
+        maintenance_interval: float, max_reads: int, max_writes: int,
+        max_queue: int, queue_timeout: float, profile_dir: str,
+        profile_rate: float, profile_secret: str, profile_interval: float):
+    if listing_cache_bytes and workers != 1:
+        # Workers would miss each other's changes, and serve stale lists.
+        raise click.UsageError(
+            "--listing-cache-bytes only works with a single worker.")
+    if storage == "memory" and workers != 1:
+        # Each worker would get its own empty databases.
+        raise click.UsageError(
+            "--storage memory only works with a single worker.")
+
+    sockets = tornado.netutil.bind_sockets(port)
+    if workers != 1:
+        # Migrate once, before forking, so the workers don't race each
+        # other.  No event loop or database thread may outlive this.
+        migration_loop = asyncio.new_event_loop()
+        migration_loop.run_until_complete(
+            migrate(database, storage, shards))
+        migration_loop.close()
+
+        # Ctrl-C reaches every worker; the parent exits when they have.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print(f"Listening on port {port}...")
+        parent = os.getpid()
+        task_id = tornado.process.fork_processes(workers)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    else:
+        parent = None
+        task_id = None
+
+    # Each worker builds its own connections and caches after the fork.
     loop = tornado.ioloop.IOLoop.current()
-    dbmanager = widgets.database.ConnectionManager(database, loop)
-    loop.add_callback(widgets.migrations.run_migrations, dbmanager)
+    profiler = None
+    if profile_dir:
+        name = None if task_id is None else f"worker-{task_id}"
+        profiler = widgets.profiling.Profiler(
+            profile_dir, profile_rate, profile_secret, name)
+    dbmanager = widgets.database.ConnectionManager(
+        database, loop,
+        storage=storage,
+        shards=shards,
+        pool_size=pool_size,
+        token_cache_size=token_cache_size,
+        token_ttl=token_ttl,
+        commit_delay=commit_delay,
+        listing_cache_bytes=listing_cache_bytes,
+        max_reads=max_reads,
+        max_writes=max_writes,
+        max_queue=max_queue,
+        queue_timeout=queue_timeout,
+        profiler=profiler,
+    )
+    # Connections wait in the listen backlog until the schema is ready.
+    loop.run_sync(lambda: startup(dbmanager, migrate=task_id is None))
     params = {'dbmanager': dbmanager}
     app = tornado.web.Application([
         (r"/", widgets.auth.AccountHandler, params),
         (r"/widgets/", widgets.widgets.WidgetHandler, params),
+        (r"/widgets/batch", widgets.widgets.WidgetBatchHandler, params),
+        (r"/widgets/totals", widgets.widgets.WidgetTotalsHandler, params),
+        (r"/widgets/changes", widgets.changes.ChangesHandler, params),
+        (r"/widgets/socket", widgets.changes.ChangesSocketHandler, params),
+        (r"/metrics", widgets.metrics.MetricsHandler),
     ])
-    app.listen(8888)
-    print("Listening...")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    if task_id is None:
+        print("Listening...")
+
+    def shutdown(signum, frame):
+        loop.add_callback_from_signal(loop.stop)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    if maintenance_interval and not task_id:
+        # One process is enough to look after the database.
+        retention = retention_days * 24 * 60 * 60
+
+        async def maintain():
+            await widgets.maintenance.run_maintenance(dbmanager, retention)
+
+        tornado.ioloop.PeriodicCallback(
+            maintain, maintenance_interval * 1000).start()
+
+    if profiler is not None:
+        tornado.ioloop.PeriodicCallback(
+            profiler.write, profile_interval * 1000).start()
+
+    if parent is not None:
+        # Workers outlive a parent that was killed; stop them too.
+        def check_parent():
+            if os.getppid() != parent:
+                loop.stop()
+
+        tornado.ioloop.PeriodicCallback(check_parent, 1000).start()
+
     loop.start()
 
+    # Close the pooled connections cleanly, checkpointing the WAL file.
+    server.stop()
+    loop.run_sync(dbmanager.close)
+    if profiler is not None:
+        profiler.write()
+    if task_id is None:
+        print(f"Token cache: {dbmanager.tokens.stats()}")
+        if dbmanager.listings is not None:
+            print(f"Listing cache: {dbmanager.listing_cache_counts()}")
+        print("Stopped.")
+    else:
+        print(f"Worker {task_id} token cache: {dbmanager.tokens.stats()}")
+
+
+@cli.command("export")
+@database_option
+@shards_option
+@click.option('--gzip', 'compress', is_flag=True,
+              help="Compress the output; the default for .gz files.")
+@click.argument('output', type=click.File("wb"), default="-")
+def export_data(database: str, shards: int, compress: bool, output):
+    # Safe to run alongside the server, which carries on as usual.
+    if compress or output.name.endswith(".gz"):
+        output = gzip.GzipFile(fileobj=output, mode="wb")
+    try:
+        count = run_command(database, shards,
+                            widgets.transfer.export_records, output)
+    finally:
+        output.close()
+    click.echo(f"Exported {count} records.", err=True)
+
+
+@cli.command("import")
+@database_option
+@shards_option
+@click.argument('input', type=click.File("rb"), default="-")
+def import_data(database: str, shards: int, input):
+    # The databases must be empty, and the server must not be running.
+    if input.peek(2)[:2] == b"\x1f\x8b":
+        input = gzip.GzipFile(fileobj=input, mode="rb")
+    count = run_command(database, shards,
+                        widgets.transfer.import_records, input)
+    click.echo(f"Imported {count} records.")
+
 
 if __name__ == "__main__":
-    run()
+    cli()
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import tornado.httpclient
+import tornado.ioloop
+
+
+class Endpoint:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def percentile(self, fraction):
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, int(fraction * len(ordered)))
+        return round(ordered[index] * 1000, 3)
+
+    def report(self):
+        count = len(self.latencies)
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'rps': round(count / self.elapsed, 1) if self.elapsed else None,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+        }
+
+
+class Benchmark:
+    def __init__(self, base_url, concurrency):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=concurrency)
+
+    async def call(self, method, path, body=None, token=None):
+        headers = {}
+        if token:
+            headers['Authorization'] = f"Bearer {token}"
+        if body is not None:
+            body = json.dumps(body)
+        elif method in ('POST', 'PUT', 'PATCH'):
+            body = ""
+        request = tornado.httpclient.HTTPRequest(
+            self.base_url + path,
+            method=method,
+            headers=headers,
+            body=body,
+            allow_nonstandard_methods=True,
+        )
+        response = await self.client.fetch(request, raise_error=False)
+        return response
+
+    async def wait_until_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                response = await self.call('GET', "/")
+            except OSError:
+                response = None
+            if response is not None and response.code == 401:
+                return
+            await asyncio.sleep(0.1)
+        raise click.ClickException("The server didn't start in time.")
+
+    async def seed(self, accounts, widgets_per_account):
+        tokens = []
+        widget_ids = []
+        for n in range(accounts):
+            response = await self.call('POST', "/", {'name': f"bench-{n}"})
+            token = json.loads(response.body)['token']
+            tokens.append(token)
+
+            for start in range(0, widgets_per_account, 1000):
+                count = min(1000, widgets_per_account - start)
+                operations = [
+                    {'op': 'create', 'name': f"widget-{start + i}",
+                     'parts': 1 + i, 'description': "Seeded."}
+                    for i in range(count)
+                ]
+                response = await self.call('POST', "/widgets/batch",
+                                           {'operations': operations},
+                                           token=token)
+                results = json.loads(response.body)['results']
+                widget_ids.extend((token, result['widget']['id'])
+                                  for result in results)
+        return tokens, widget_ids
+
+    async def measure(self, name, requests):
+        endpoint = Endpoint(name)
+        queue = list(reversed(requests))
+
+        async def worker():
+            while queue:
+                method, path, body, token, expected = queue.pop()
+                started = time.perf_counter()
+                try:
+                    response = await self.call(method, path, body, token)
+                    code = response.code
+                except Exception:
+                    code = None
+                endpoint.latencies.append(time.perf_counter() - started)
+                if code != expected:
+                    endpoint.errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for n in range(self.concurrency)])
+        endpoint.elapsed = time.perf_counter() - started
+        return endpoint
+
+    async def run(self, count, tokens, widget_ids):
+        def cycle(items):
+            return [items[n % len(items)] for n in range(count)]
+
+        # The mutations each use a different widget, so the deletes can
+        # all succeed, followed by the restores.
+        targets = widget_ids[:count]
+        scenarios = [
+            ("GET /", [('GET', "/", None, token, 200)
+                       for token in cycle(tokens)]),
+            ("POST /", [('POST', "/", {'name': "bench"}, None, 200)
+                        for n in range(count)]),
+            ("GET /widgets/", [('GET', "/widgets/", None, token, 200)
+                               for token in cycle(tokens)]),
+            ("POST /widgets/", [('POST', "/widgets/",
+                                 {'name': "bench", 'parts': 3}, token, 200)
+                                for token in cycle(tokens)]),
+            ("PUT /widgets/", [('PUT', "/widgets/",
+                                {'id': widget_id, 'parts': 7}, token, 200)
+                               for token, widget_id in targets]),
+            ("DELETE /widgets/", [('DELETE', "/widgets/",
+                                   {'id': widget_id}, token, 200)
+                                  for token, widget_id in targets]),
+            ("PATCH /widgets/", [('PATCH', "/widgets/",
+                                  {'id': widget_id}, token, 200)
+                                 for token, widget_id in targets]),
+        ]
+
+        results = {}
+        for name, requests in scenarios:
+            endpoint = await self.measure(name, requests)
+            results[name] = endpoint.report()
+            print(f"{name}: {results[name]}", file=sys.stderr)
+        return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit(here):
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=here,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+@click.command()
+@click.option('--accounts', default=10, type=click.IntRange(min=1),
+              help="Number of accounts to create.")
+@click.option('--widgets', default=1000, type=click.IntRange(min=1),
+              help="Number of widgets to create in each account.")
+@click.option('--requests', default=2000, type=click.IntRange(min=1),
+              help="Number of requests to send to each endpoint.")
+@click.option('--concurrency', default=32, type=click.IntRange(min=1),
+              help="Number of requests to keep in flight.")
+@click.option('--workers', default=1, type=click.IntRange(min=0),
+              help="Number of server processes to run.")
+@click.option('--storage', default="sqlite",
+              type=click.Choice(["memory", "sqlite"]),
+              help="Storage engine for the server to use.")
+@click.option('--shards', default=1, type=click.IntRange(min=1),
+              help="Number of databases for the server to use.")
+@click.option('--output', type=click.File("w"), default="-",
+              help="Where to write the JSON results.")
+def benchmark(accounts, widgets, requests, concurrency, workers, storage,
+              shards, output):
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        port = free_port()
+        command = [
+            sys.executable, os.path.join(here, "application.py"), "run",
+            "--port", str(port),
+            "--database", os.path.join(tmpdir, "benchmark.sqlite"),
+            "--workers", str(workers),
+            "--storage", storage,
+            "--shards", str(shards),
+        ]
+        server = subprocess.Popen(command, cwd=tmpdir,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            async def main():
+                bench = Benchmark(f"http://127.0.0.1:{port}", concurrency)
+                await bench.wait_until_ready()
+                print("Seeding...", file=sys.stderr)
+                tokens, widget_ids = await bench.seed(accounts, widgets)
+                return await bench.run(requests, tokens, widget_ids)
+
+            results = tornado.ioloop.IOLoop.current().run_sync(main)
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'commit': git_commit(here),
+        'config': {
+            'accounts': accounts,
+            'widgets': widgets,
+            'requests': requests,
+            'concurrency': concurrency,
+            'workers': workers,
+            'storage': storage,
+            'shards': shards,
+        },
+        'endpoints': results,
+    }
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,61 @@
+import asyncio
+import collections
+
+
+class Overloaded(Exception):
+    pass
+
+
+# Lets a limited number of requests through at a time, and queues a limited
+# number more, each for a limited time.  Past that, callers get turned away
+# right away, rather than piling up behind a busy database.
+class AdmissionGate:
+    def __init__(self, limit, max_queue, timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = collections.deque()
+        self.rejected = collections.Counter()
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            self.rejected["full"] += 1
+            raise Overloaded("The queue is full.")
+
+        # release() hands its slot straight to the first one waiting.
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return
+            self.abandon(waiter)
+            self.rejected["timeout"] += 1
+            raise Overloaded("Timed out in the queue.")
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release()
+            else:
+                self.abandon(waiter)
+            raise
+
+    def abandon(self, waiter):
+        waiter.cancel()
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
@@ -3,32 +3,96 @@ import uuid
 
 import tornado.web
 
+import widgets.admission
+import widgets.database
+import widgets.metrics
+
+request_seconds = widgets.metrics.Histogram(
+    "widgets_request_seconds",
+    "Time spent handling requests, by handler and method.",
+    ["handler", "method"])
+requests_in_flight = widgets.metrics.Gauge(
+    "widgets_requests_in_flight",
+    "Number of requests currently being handled.")
+
 
 class AuthorizedRequestHandler(tornado.web.RequestHandler):
     def initialize(self, dbmanager):
         self.dbmanager = dbmanager
 
     async def prepare(self):
+        self.in_flight = True
+        requests_in_flight.inc()
         self.account_id = None
         self.account_code = None
+
         auth = self.request.headers.get('Authorization')
         if auth and auth.startswith('Bearer '):
             token = auth.split(" ", 1)[1]
-            async with self.dbmanager.connect() as db:
-                query = """
-                    SELECT account_id
-                    FROM tokens
-                    WHERE token = ?
-                    LIMIT 1
-                """
-                async with db.execute(query, (token,)) as cursor:
-                    async for row in cursor:
-                        self.account_id = row[0]
-            if self.account_id is not None:
-                encoder = self.dbmanager.encode_id
-                self.account_code = await encoder("account", self.account_id)
+            account = self.dbmanager.tokens.get(token)
+            if account is self.dbmanager.tokens.missing:
+                unknown = self.dbmanager.unknown_tokens
+                if unknown.get(token) is unknown.missing:
+                    account = await self.lookup_token(token)
+                else:
+                    account = None
+            if account is not None:
+                self.account_id, self.account_code = account
+
+        profiler = self.dbmanager.profiler
+        if profiler is not None:
+            profiler.attach(self)
+
+    async def lookup_token(self, token):
+        account_id = None
+        async with self.dbmanager.connect() as db:
+            query = """
+                SELECT account_id
+                FROM tokens
+                WHERE token = ?
+                LIMIT 1
+            """
+            async with db.execute(query, (token,)) as cursor:
+                async for row in cursor:
+                    account_id = row[0]
+
+        if account_id is None:
+            # Remember bogus tokens too, but not for long, and apart from
+            # the real ones, so a flood of them can't push those out.
+            self.dbmanager.unknown_tokens.set(token, True)
+            return None
+
+        encoder = self.dbmanager.encode_id
+        account = (account_id, await encoder("account", account_id))
+        self.dbmanager.tokens.set(token, account)
+        return account
+
+    def on_finish(self):
+        if getattr(self, "in_flight", False):
+            self.in_flight = False
+            requests_in_flight.dec()
+        handler = type(self).__name__
+        method = self.request.method
+        if method not in self.SUPPORTED_METHODS:
+            # Clients can send any method at all; don't keep a series for
+            # each one.
+            method = "other"
+        elapsed = self.request.request_time()
+        request_seconds.observe(elapsed, handler, method)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, widgets.admission.Overloaded):
+            super().log_exception(typ, value, tb)
 
     def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get("exc_info")
+        if exc_info and isinstance(exc_info[1], widgets.admission.Overloaded):
+            # The database has more to do than it can get through in time.
+            # Quick to send, and tells well-behaved clients to back off.
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.write({'error': 'Service Unavailable'})
+            return
         self.write({'error': 'Internal Error'})
 
 
@@ -53,6 +117,7 @@ class AccountHandler(AuthorizedRequestHandler):
                     accounts.append(dict(zip(fields, row)))
 
         for account in accounts:
+            widgets.database.format_times(account)
             account['id'] = self.account_code
 
         self.write({
@@ -78,7 +143,7 @@ class AccountHandler(AuthorizedRequestHandler):
             self.write({'error': 'name is required'})
             return
 
-        async with self.dbmanager.connect() as db:
+        async with self.dbmanager.connect(write=True) as db:
             now = self.dbmanager.now()
             query = """
                 INSERT INTO accounts (name, created, updated)
@@ -98,6 +163,8 @@ class AccountHandler(AuthorizedRequestHandler):
             await db.commit()
 
         account_code = await self.dbmanager.encode_id("account", account_id)
+        # This token might have been tried before it existed.
+        self.dbmanager.forget_token(token)
         self.write({
             'account': account_code,
             'token': token,
@@ -0,0 +1,75 @@
+import collections
+import time
+
+
+# A bounded mapping that forgets its least recently used entries, and
+# optionally anything older than its time-to-live, in seconds.  With a weigh
+# function, the bound applies to the total weight of its values instead of
+# their number, such as a budget of bytes.
+class LRUCache:
+    missing = object()
+
+    def __init__(self, maxsize=1024, ttl=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.entries = collections.OrderedDict()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=missing):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, weight, value = entry
+            if expires is None or time.monotonic() < expires:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.discard(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        weight = 1 if self.weigh is None else self.weigh(value)
+        self.discard(key)
+        if weight > self.maxsize:
+            return
+        self.entries[key] = (expires, weight, value)
+        self.weight += weight
+        while self.weight > self.maxsize:
+            key, (expires, weight, value) = self.entries.popitem(last=False)
+            self.weight -= weight
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[1]
+
+    def discard_where(self, predicate):
+        stale = [key for key, (expires, weight, value) in self.entries.items()
+                 if predicate(key, value)]
+        for key in stale:
+            self.discard(key)
+        return len(stale)
+
+    def clear(self):
+        self.entries.clear()
+        self.weight = 0
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'weight': self.weight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
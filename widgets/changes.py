@@ -0,0 +1,92 @@
+import asyncio
+
+import tornado.websocket
+
+import widgets.auth
+
+# Seconds to hold a long-polling request open when nothing changes.
+POLL_TIMEOUT = 30.0
+
+
+class ChangesHandler(widgets.auth.AuthorizedRequestHandler):
+    # Long-polling: answers as soon as any of the account's widgets change
+    # after the given sequence number, or with no events after a while.
+    async def get(self):
+        if not self.account_id:
+            self.set_status(401)
+            self.write({'error': 'Not Authorized'})
+            return
+
+        notifier = self.dbmanager.notifier
+        after = self.get_argument("after", None)
+        if after is None:
+            after = notifier.sequence
+        else:
+            try:
+                after = notifier.parse_cursor(after)
+            except ValueError:
+                self.set_status(400)
+                self.write({'error': {'after': 'after must be a cursor'}})
+                return
+
+        # A cursor from before a restart, or from another worker, can't
+        # say what this process has sent since.
+        events = None
+        if after is not None:
+            self.waiting = asyncio.ensure_future(
+                notifier.wait(self.account_id, after, POLL_TIMEOUT))
+            try:
+                events = await self.waiting
+            except asyncio.CancelledError:
+                return
+
+        # Changes went by that weren't kept for us.  The client can catch
+        # up on them with a sync request, then start again from here.
+        reset = events is None
+        if reset:
+            events = []
+            after = notifier.sequence
+        elif events:
+            after = events[-1]["seq"]
+
+        self.write({
+            'account': self.account_code,
+            'events': events,
+            'after': notifier.cursor(after),
+            'reset': reset,
+        })
+
+    def on_connection_close(self):
+        waiting = getattr(self, "waiting", None)
+        if waiting is not None:
+            waiting.cancel()
+
+
+class ChangesSocketHandler(tornado.websocket.WebSocketHandler,
+                           widgets.auth.AuthorizedRequestHandler):
+    # Sends each of the account's widget changes as its own message, for as
+    # long as the connection stays open.
+
+    async def get(self, *args, **kwargs):
+        if not self.account_id:
+            self.set_status(401)
+            self.finish({'error': 'Not Authorized'})
+            return
+        await super().get(*args, **kwargs)
+
+    def open(self):
+        self.dbmanager.notifier.subscribe(self.account_id, self.send_event)
+
+    def send_event(self, event):
+        try:
+            self.write_message(event)
+        except tornado.websocket.WebSocketClosedError:
+            self.dbmanager.notifier.unsubscribe(self.account_id,
+                                                self.send_event)
+
+    def on_message(self, message):
+        # Nothing to say back; the changes only flow one way.
+        pass
+
+    def on_close(self):
+        self.dbmanager.notifier.unsubscribe(self.account_id, self.send_event)
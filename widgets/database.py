@@ -1,83 +1,723 @@
+import asyncio
+import collections
 import datetime
+import itertools
+import os
+import re
+import time
 
 import aiosqlite
 
+import widgets.admission
+import widgets.cache
 import widgets.idencoder
+import widgets.metrics
+import widgets.notify
 
+connect_seconds = widgets.metrics.Histogram(
+    "widgets_db_connect_seconds",
+    "Time spent waiting for a pooled database connection.",
+    ["pool"])
+query_seconds = widgets.metrics.Histogram(
+    "widgets_db_query_seconds",
+    "Time spent running each kind of database statement.",
+    ["statement"])
+commit_seconds = widgets.metrics.Histogram(
+    "widgets_db_commit_seconds",
+    "Time spent committing database transactions.",
+    ["pool"])
+alphabet_lookups = widgets.metrics.Counter(
+    "widgets_alphabet_lookups_total",
+    "Alphabet lookups, by whether they were already in memory.",
+    ["result"])
 
-class ConnectionManager:
-    def __init__(self, database, loop):
+
+# Applied to every pooled connection as soon as it opens.  WAL lets the
+# readers keep going while the writer commits, and NORMAL synchronous mode
+# is still durable across application crashes in WAL mode.  Incremental
+# auto-vacuum lets maintenance give space back, but only takes hold in a
+# brand-new database, before anything else touches it, or after a VACUUM.
+PRAGMAS = [
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+]
+
+
+# Timestamps get stored as integer microseconds since the epoch, and only
+# turned back into text for responses.
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+TIMESTAMP_FIELDS = ("created", "updated", "deleted")
+
+
+def timestamp(moment):
+    return (moment - EPOCH) // MICROSECOND
+
+
+def format_time(value):
+    if value is None:
+        return None
+    return str(EPOCH + value * MICROSECOND)
+
+
+def format_times(record):
+    for field in TIMESTAMP_FIELDS:
+        if field in record:
+            record[field] = format_time(record[field])
+    return record
+
+
+statement_labels = {}
+
+
+def statement_label(sql):
+    # "SELECT widgets", "UPDATE tokens", "PRAGMA", and so on.
+    label = statement_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        label = words[0].upper() if words else ""
+        match = re.search(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", sql, re.I)
+        if match:
+            label = f"{label} {match.group(1)}"
+        if len(statement_labels) < 1000:
+            statement_labels[sql] = label
+    return label
+
+
+class TimedResult:
+    def __init__(self, result, sql):
+        self.result = result
+        self.sql = sql
+        self.cursor = None
+
+    async def timed(self):
+        started = time.perf_counter()
+        try:
+            return await self.result
+        finally:
+            elapsed = time.perf_counter() - started
+            query_seconds.observe(elapsed, statement_label(self.sql))
+
+    def __await__(self):
+        return self.timed().__await__()
+
+    async def __aenter__(self):
+        self.cursor = await self.timed()
+        return self.cursor
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.cursor.close()
+
+
+class TimedConnection:
+    # Wraps an aiosqlite connection, recording how long statements take.
+    def __init__(self, db, pool):
+        self.db = db
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def execute(self, sql, parameters=None):
+        return TimedResult(self.db.execute(sql, parameters), sql)
+
+    def executemany(self, sql, parameters):
+        return TimedResult(self.db.executemany(sql, parameters), sql)
+
+    async def commit(self):
+        started = time.perf_counter()
+        try:
+            await self.db.commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            commit_seconds.observe(elapsed, self.pool.name)
+
+
+class PooledConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.db = None
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        self.db = await self.pool.acquire()
+        connect_seconds.observe(time.perf_counter() - started, self.pool.name)
+        return TimedConnection(self.db, self.pool)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        db, self.db = self.db, None
+        await self.pool.release(db, broken=exc_type is not None)
+
+
+class AdmittedConnection:
+    # A pooled connection that takes its turn at an admission gate first,
+    # and holds its place only for as long as it holds the connection.
+    def __init__(self, gate, connection):
+        self.gate = gate
+        self.connection = connection
+
+    async def __aenter__(self):
+        await self.gate.acquire()
+        try:
+            return await self.connection.__aenter__()
+        except BaseException:
+            self.gate.release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.connection.__aexit__(exc_type, exc, tb)
+        finally:
+            self.gate.release()
+
+
+class ConnectionPool:
+    def __init__(self, name, database, size, pragmas=(),
+                 health_interval=30.0):
+        self.name = name
         self.dbfilename = database
-        self.loop = None
-        self.alphabets = {}
+        self.size = size
+        self.pragmas = list(pragmas)
+        self.health_interval = health_interval
+        self.idle = collections.deque()
+        self.opened = 0
+        self.semaphore = None
+        self.closed = False
+        self.generation = 0
+        self.generations = {}
 
-    def connect(self):
-        return aiosqlite.connect(self.dbfilename, loop=self.loop)
+    async def open(self):
+        db = await aiosqlite.connect(self.dbfilename, uri=True)
+        for pragma in self.pragmas:
+            await db.execute(pragma)
+        self.opened += 1
+        self.generations[db] = self.generation
+        return db
 
-    @staticmethod
-    def now():
-        return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    async def discard(self, db):
+        self.opened -= 1
+        self.generations.pop(db, None)
+        try:
+            await db.close()
+        except Exception:
+            pass
 
-    async def insert_row(self, table, **fields):
-        keys, values = zip(*fields.items())
-        query = f"""
-            INSERT INTO {table} ({', '.join(keys)})
-            VALUES ({', '.join('?' for key in keys)})
-        """
-        async with self.connect() as db:
-            cursor = await db.execute(query, values)
-            item_id = cursor.lastrowid
+    async def healthy(self, db):
+        try:
+            async with db.execute("SELECT 1") as cursor:
+                await cursor.fetchall()
+        except Exception:
+            return False
+        return True
+
+    async def acquire(self):
+        if self.closed:
+            raise RuntimeError("Connection pool is closed.")
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.size)
+
+        await self.semaphore.acquire()
+        try:
+            while self.idle:
+                db, last_used = self.idle.pop()
+                idle_time = time.monotonic() - last_used
+                if idle_time < self.health_interval or await self.healthy(db):
+                    return db
+                await self.discard(db)
+            return await self.open()
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    async def release(self, db, broken=False):
+        try:
+            if broken:
+                # Don't hand a half-finished transaction to the next caller.
+                try:
+                    await db.rollback()
+                except Exception:
+                    await self.discard(db)
+                    return
+            if self.closed or self.generations.get(db) != self.generation:
+                await self.discard(db)
+            else:
+                self.idle.append((db, time.monotonic()))
+        finally:
+            self.semaphore.release()
+
+    async def recycle(self):
+        # Replaces every connection, as they come back, such as to pick up
+        # new query planner statistics.
+        self.generation += 1
+        while self.idle:
+            db, last_used = self.idle.pop()
+            await self.discard(db)
+
+    async def close(self):
+        self.closed = True
+        while self.idle:
+            db, last_used = self.idle.pop()
+            await self.discard(db)
+
+
+WriteResult = collections.namedtuple("WriteResult",
+                                     ["lastrowid", "rowcount", "rows"])
+
+
+class WriteQueue:
+    # Runs single-statement writes from many requests on the writer
+    # connection, committing each batch of them together.  Every statement
+    # gets its own savepoint, so one failure doesn't spoil the rest.
+    def __init__(self, pool, delay=0.002, batch_size=100):
+        self.pool = pool
+        self.delay = delay
+        self.batch_size = batch_size
+        self.queue = None
+        self.task = None
+
+    async def execute(self, query, params, fetch=False):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((query, params, fetch, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            while self.queue.qsize() and len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await self.commit(batch)
+            except Exception as error:
+                for query, params, fetch, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+    async def commit(self, batch):
+        results = []
+        async with PooledConnection(self.pool) as db:
+            # Without an enclosing transaction, each RELEASE would commit.
+            await db.execute("BEGIN IMMEDIATE")
+            for query, params, fetch, future in batch:
+                await db.execute("SAVEPOINT queued")
+                try:
+                    cursor = await db.execute(query, params)
+                    # Rows from a RETURNING clause.
+                    rows = await cursor.fetchall() if fetch else None
+                except Exception as error:
+                    await db.execute("ROLLBACK TO queued")
+                    results.append((future, error))
+                else:
+                    result = WriteResult(cursor.lastrowid, cursor.rowcount,
+                                         rows)
+                    results.append((future, result))
+                await db.execute("RELEASE queued")
             await db.commit()
 
-        return item_id
+        for future, result in results:
+            if future.done():
+                pass
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
-    async def update(self, table, changes, **selected):
-        fields, values = zip(*changes.items())
-        keys, params = zip(*selected.items())
-        settings = ', '.join(f'{field} = ?' for field in fields)
-        conditions = ' AND '.join(f'{key} = ?' for key in keys)
+    async def close(self):
+        if self.queue is not None:
+            await self.queue.join()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+def listing_weight(pages):
+    return sum(len(body) + len(etag) for etag, body in pages.values())
+
+
+class Database:
+    # One SQLite database: a pool of readers, plus one writer connection
+    # and the queue of writes waiting for it.
+    def __init__(self, target, index=0, shards=1, pool_size=4,
+                 commit_delay=0.002, commit_batch_size=100, keep_open=False):
+        self.target = target
+        self.index = index
+        self.shards = shards
+        self.keep_open = keep_open
+        self.anchor = None
+        suffix = f"-{index}" if index else ""
+        self.readers = ConnectionPool(f"read{suffix}", target, pool_size,
+                                      PRAGMAS + ["PRAGMA query_only = ON"])
+        self.writers = ConnectionPool(f"write{suffix}", target, 1, PRAGMAS)
+        self.writes = WriteQueue(self.writers, commit_delay, commit_batch_size)
+
+    async def open(self):
+        # An in-memory database only lasts while a connection to it does.
+        if self.keep_open and self.anchor is None:
+            self.anchor = await aiosqlite.connect(self.target, uri=True)
+
+    def connect(self, write=False):
+        # Readers share a pool; all writes go through one dedicated
+        # connection, so they queue here instead of on the SQLite lock.
+        pool = self.writers if write else self.readers
+        return PooledConnection(pool)
+
+    async def close(self):
+        await self.writes.close()
+        await self.readers.close()
+        await self.writers.close()
+        if self.anchor is not None:
+            await self.anchor.close()
+            self.anchor = None
+
+    async def write(self, query, params, fetch=False):
+        # Runs a single statement on the writer connection, as part of the
+        # next group commit.
+        return await self.writes.execute(query, params, fetch)
+
+    def widget_id_sql(self, floor=0):
+        # The next widget id this database hands out: the smallest one above
+        # both the floor and every id here, that leaves this database's
+        # index when divided by the number of shards.  That way no two
+        # databases ever pick the same one.
+        shards, index = self.shards, self.index
+        return f"""(
+            SELECT (MAX(IFNULL(MAX(id), 0), {int(floor)}) + {shards - index})
+                / {shards} * {shards} + {index}
+            FROM widgets
+        )"""
+
+    async def insert_widget(self, floor=0, **fields):
+        keys, values = zip(*fields.items())
         query = f"""
-            UPDATE {table} SET {settings}
-            WHERE {conditions}
+            INSERT INTO widgets (id, {', '.join(keys)})
+            VALUES ({self.widget_id_sql(floor)},
+                    {', '.join('?' for key in keys)})
         """
-        async with self.connect() as db:
-            cursor = await db.execute(query, values + params)
-            await db.commit()
-            changed = db.total_changes
+        result = await self.writes.execute(query, values)
+        return result.lastrowid
+
+
+# Each storage engine lays out the databases for a ConnectionManager.  The
+# first one holds the accounts, tokens, and alphabets, and each account's
+# widgets go to the database its id picks out.
+storage_engines = {}
+
+
+def storage_engine(f):
+    storage_engines[f.__name__] = f
+    return f
+
+
+@storage_engine
+def sqlite(database, shards, **options):
+    # Database files on disk.  Extra shards go alongside the first, as
+    # database-1.sqlite, database-2.sqlite, and so on.
+    stem, extension = os.path.splitext(database)
+    targets = [database] + [f"{stem}-{n}{extension}"
+                            for n in range(1, shards)]
+    return [Database(target, n, shards, **options)
+            for n, target in enumerate(targets)]
+
+
+memory_databases = itertools.count()
+
+
+@storage_engine
+def memory(database, shards, **options):
+    # Nothing touches the disk, and everything is gone when the process
+    # exits.  Meant for tests and benchmarks.
+    return [Database(f"file:/widgets-{next(memory_databases)}?vfs=memdb",
+                     n, shards, keep_open=True, **options)
+            for n in range(shards)]
+
+
+class ConnectionManager:
+    def __init__(self, database, loop, pool_size=4,
+                 token_cache_size=4096, token_ttl=60.0, unknown_token_ttl=5.0,
+                 unknown_token_cache_size=1024, commit_delay=0.002,
+                 commit_batch_size=100, listing_cache_bytes=0, max_reads=64,
+                 max_writes=16, max_queue=256, queue_timeout=5.0,
+                 storage="sqlite", shards=1, profiler=None):
+        self.loop = None
+        # A widgets.profiling.Profiler, when sampling requests.
+        self.profiler = profiler
+        self.alphabets = {}
+        self.alphabet_loads = {}
+        self.id_floor = None
+        self.tokens = widgets.cache.LRUCache(token_cache_size, token_ttl)
+        self.unknown_tokens = widgets.cache.LRUCache(
+            unknown_token_cache_size, unknown_token_ttl)
+        widgets.metrics.CallbackMetric(
+            "widgets_token_cache_lookups_total",
+            "Auth token lookups, by whether they were already in memory.",
+            "counter",
+            self.token_cache_counts,
+            ["result"])
+
+        # Serialized widget listings, by account; see cached_listing().
+        self.listings = None
+        self.listing_generations = collections.defaultdict(int)
+        self.listing_hits = 0
+        self.listing_misses = 0
+        if listing_cache_bytes:
+            self.listings = widgets.cache.LRUCache(
+                listing_cache_bytes, weigh=listing_weight)
+            widgets.metrics.CallbackMetric(
+                "widgets_listing_cache_total",
+                "Widget listing cache lookups and evictions.",
+                "counter",
+                self.listing_cache_counts,
+                ["result"])
+            widgets.metrics.CallbackMetric(
+                "widgets_listing_cache_bytes",
+                "Size of the widget listings held in memory.",
+                "gauge",
+                lambda: {(): self.listings.weight})
 
-        return changed
+        # Widget changes, for the clients waiting to hear about them.
+        self.notifier = widgets.notify.Notifier()
+        widgets.metrics.CallbackMetric(
+            "widgets_change_listeners",
+            "Connections waiting to hear about widget changes.",
+            "gauge",
+            lambda: {(): self.notifier.listener_count()})
+
+        # Limits on how much reading and writing goes on at once; see
+        # connect() and write().
+        self.admission = {
+            "read": widgets.admission.AdmissionGate(
+                max_reads, max_queue, queue_timeout),
+            "write": widgets.admission.AdmissionGate(
+                max_writes, max_queue, queue_timeout),
+        }
+        widgets.metrics.CallbackMetric(
+            "widgets_admission_queue_depth",
+            "Requests waiting for their turn at the database.",
+            "gauge",
+            lambda: self.admission_counts(lambda gate: len(gate.waiters)),
+            ["kind"])
+        widgets.metrics.CallbackMetric(
+            "widgets_admission_active",
+            "Requests admitted and still using the database.",
+            "gauge",
+            lambda: self.admission_counts(lambda gate: gate.active),
+            ["kind"])
+        widgets.metrics.CallbackMetric(
+            "widgets_admission_rejected_total",
+            "Requests turned away with a 503, by why.",
+            "counter",
+            self.admission_rejections,
+            ["kind", "reason"])
+
+        self.databases = storage_engines[storage](
+            database, shards,
+            pool_size=pool_size,
+            commit_delay=commit_delay,
+            commit_batch_size=commit_batch_size,
+        )
+
+    def database(self, account_id=None):
+        # Where the account's widgets live.  The number of shards must never
+        # change once there are any, or accounts would lose track of them.
+        if account_id is None:
+            return self.databases[0]
+        return self.databases[account_id % len(self.databases)]
+
+    def connect(self, write=False, account_id=None):
+        # Requests only count against the admission limits while they use
+        # the database, not while they send a response or wait for news.
+        gate = self.admission["write" if write else "read"]
+        return AdmittedConnection(gate,
+                                  self.database(account_id).connect(write))
+
+    async def open(self):
+        for database in self.databases:
+            await database.open()
+
+    async def close(self):
+        for database in self.databases:
+            await database.close()
+
+    def admission_counts(self, count):
+        return dict(((kind,), count(gate))
+                    for kind, gate in self.admission.items())
+
+    def admission_rejections(self):
+        counts = {}
+        for kind, gate in self.admission.items():
+            for reason in ("full", "timeout"):
+                counts[(kind, reason)] = gate.rejected[reason]
+        return counts
+
+    def token_cache_counts(self):
+        return {("hit",): self.tokens.hits, ("miss",): self.tokens.misses}
+
+    def listing_cache_counts(self):
+        return {
+            ("hit",): self.listing_hits,
+            ("miss",): self.listing_misses,
+            ("eviction",): self.listings.evictions,
+        }
+
+    def cached_listing(self, account_id, key):
+        if self.listings is None:
+            return None
+        pages = self.listings.get(account_id, None) or {}
+        listing = pages.get(key)
+        if listing is None:
+            self.listing_misses += 1
+        else:
+            self.listing_hits += 1
+        return listing
+
+    def cache_listing(self, account_id, generation, key, etag, body):
+        # Anything read before the latest change to the account is stale.
+        if self.listings is None:
+            return
+        if generation != self.listing_generations[account_id]:
+            return
+        pages = dict(self.listings.get(account_id, None) or {})
+        pages[key] = (etag, body)
+        self.listings.set(account_id, pages)
+
+    def forget_listings(self, account_id):
+        # Call this after every change to an account's widgets.
+        self.listing_generations[account_id] += 1
+        if self.listings is not None:
+            self.listings.discard(account_id)
+
+    def forget_token(self, token):
+        # Call this whenever a token gets revoked or rotated, or created
+        # after someone may have tried it.
+        self.tokens.discard(token)
+        self.unknown_tokens.discard(token)
+
+    def forget_account_tokens(self, account_id):
+        return self.tokens.discard_where(
+            lambda token, account: account and account[0] == account_id)
+
+    @staticmethod
+    def now():
+        return timestamp(datetime.datetime.now(datetime.timezone.utc))
+
+    async def write(self, query, params, fetch=False, account_id=None):
+        database = self.database(account_id)
+        gate = self.admission["write"]
+        await gate.acquire()
+        try:
+            return await database.write(query, params, fetch)
+        finally:
+            gate.release()
+
+    async def widget_id_floor(self):
+        # The largest widget id in any database, as of the first call.  Each
+        # one hands out its own share of the ids, but an import into a
+        # different number of shards leaves ids in the wrong share, so new
+        # ones go above all of those.
+        if len(self.databases) == 1:
+            return 0
+        if self.id_floor is None:
+            floor = 0
+            for database in self.databases:
+                async with database.connect() as db:
+                    query = "SELECT MAX(id) FROM widgets"
+                    async with db.execute(query) as cursor:
+                        floor = max(floor, (await cursor.fetchone())[0] or 0)
+            self.id_floor = floor
+        return self.id_floor
+
+    async def insert_widget(self, **fields):
+        floor = await self.widget_id_floor()
+        database = self.database(fields["account_id"])
+        gate = self.admission["write"]
+        await gate.acquire()
+        try:
+            return await database.insert_widget(floor, **fields)
+        finally:
+            gate.release()
 
     async def get_alphabet(self, prefix, store=True):
         if prefix in self.alphabets:
+            alphabet_lookups.inc("hit")
             return self.alphabets[prefix]
 
+        alphabet_lookups.inc("miss")
+        # Requests that miss at the same time all wait on one load.
+        key = (prefix, store)
+        loading = self.alphabet_loads.get(key)
+        if loading is None:
+            loading = asyncio.ensure_future(self.load_alphabet(prefix, store))
+            self.alphabet_loads[key] = loading
+            loading.add_done_callback(
+                lambda future: self.alphabet_loads.pop(key, None))
+        return await asyncio.shield(loading)
+
+    async def load_alphabet(self, prefix, store):
+        query = "SELECT alphabet FROM alphabets WHERE prefix = ? LIMIT 1"
+        alphabet = None
         async with self.connect() as db:
-            alphabet = None
-            query = "SELECT alphabet FROM alphabets WHERE prefix = ? LIMIT 1"
             async with db.execute(query, (prefix,)) as cursor:
                 async for row in cursor:
                     alphabet = row[0]
 
-            if alphabet is None:
-                alphabet = widgets.idencoder.random_alphabet()
-                if not store:
-                    return alphabet
+        if alphabet is None:
+            alphabet = widgets.idencoder.random_alphabet()
+            if not store:
+                return alphabet
 
-                query = """
-                    INSERT INTO alphabets (prefix, alphabet)
+            async with self.connect(write=True) as db:
+                # Another process may have stored one in the meantime.
+                insert = """
+                    INSERT OR IGNORE INTO alphabets (prefix, alphabet)
                     VALUES (?, ?)
                 """
-                cursor = await db.execute(query, (prefix, alphabet))
+                await db.execute(insert, (prefix, alphabet))
                 await db.commit()
+                async with db.execute(query, (prefix,)) as cursor:
+                    async for row in cursor:
+                        alphabet = row[0]
 
         self.alphabets[prefix] = alphabet
         return alphabet
 
+    async def prefetch_alphabets(self, prefixes=()):
+        # Loads every stored alphabet, and creates any of the given prefixes
+        # that don't have one yet, so requests never have to wait for them.
+        async with self.connect() as db:
+            query = "SELECT prefix, alphabet FROM alphabets"
+            async with db.execute(query) as cursor:
+                async for prefix, alphabet in cursor:
+                    self.alphabets[prefix] = alphabet
+
+        for prefix in prefixes:
+            await self.get_alphabet(prefix)
+        return len(self.alphabets)
+
     async def encode_id(self, prefix, item_id):
         alphabet = await self.get_alphabet(prefix)
         code = widgets.idencoder.encode(item_id, alphabet)
         return f"{prefix}-{code}"
 
+    async def encode_ids(self, prefix, item_ids):
+        alphabet = await self.get_alphabet(prefix)
+        codes = widgets.idencoder.encode_many(item_ids, alphabet)
+        return [f"{prefix}-{code}" for code in codes]
+
     async def decode_id(self, code, default=None):
         if "-" in code:
             prefix, encoded = code.split("-", 1)
@@ -87,3 +727,14 @@ class ConnectionManager:
             prefix = None
             item_id = default
         return prefix, item_id
+
+    async def decode_ids(self, prefix, codes, default=None):
+        # Anything without the expected prefix decodes to the default.
+        alphabet = await self.get_alphabet(prefix, store=False)
+        start = f"{prefix}-"
+        encoded = [code[len(start):] if code.startswith(start) else None
+                   for code in codes]
+        item_ids = widgets.idencoder.decode_many(
+            [code or "" for code in encoded], alphabet, default)
+        return [item_id if code else default
+                for code, item_id in zip(encoded, item_ids)]
@@ -1,3 +1,11 @@
+import functools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 def random_alphabet(base: str = "bcdfghjkmnpqrstvwxz"):
     from random import shuffle
     letters = list(base)
@@ -12,40 +20,112 @@ def twiddle(number: int):
     return high | (low << 12) | (mid >> 12)
 
 
+class Codec:
+    # Below this many ids, numpy's setup costs more than it saves.
+    numpy_threshold = 256
+
+    def __init__(self, alphabet: str, min_length: int = 7):
+        self.alphabet = alphabet
+        self.length = len(alphabet)
+        self.min_length = min_length
+        self.indexes = dict((letter, n) for n, letter in enumerate(alphabet))
+        self.letters = None
+        if numpy is not None and all(ord(c) < 128 for c in alphabet):
+            self.letters = numpy.frombuffer(alphabet.encode(), numpy.uint8)
+
+    def encode(self, item_id: int):
+        if item_id < 0:
+            raise ValueError("Negative numbers cannot be encoded.", item_id)
+
+        alphabet = self.alphabet
+        length = self.length
+        min_length = self.min_length
+        letters = []
+        wobble = 0
+        number = twiddle(item_id)
+        nybble = -1
+        while number or nybble or len(letters) < min_length:
+            number, nybble = divmod(number, length)
+            index = (nybble + wobble) % length
+            wobble += index - len(letters)
+            letters.append(alphabet[index])
+        return "".join(letters)
+
+    def decode(self, code: str, default=None):
+        indexes = self.indexes
+        length = self.length
+        number = 0
+        wobble = 0
+        multiplier = 1
+        valid = True
+        nybble = None
+        for n, letter in enumerate(code):
+            index = indexes.get(letter, -1)
+            if index < 0:
+                valid = False
+
+            nybble = (index - wobble) % length
+            wobble += index - n
+            number += nybble * multiplier
+            multiplier *= length
+
+        if valid and nybble == 0:
+            return twiddle(number)
+        return default
+
+    def encode_many(self, item_ids):
+        item_ids = list(item_ids)
+        if self.letters is not None and len(item_ids) >= self.numpy_threshold:
+            if min(item_ids) >= 0 and max(item_ids) < (1 << 62):
+                return self.encode_array(item_ids)
+        return [self.encode(item_id) for item_id in item_ids]
+
+    def decode_many(self, codes, default=None):
+        return [self.decode(code, default) for code in codes]
+
+    def encode_array(self, item_ids):
+        # The same steps as encode(), a column of letters at a time.  Ids
+        # that finish early stop changing, and their letters stay zero.
+        number = numpy.array(item_ids, dtype=numpy.int64)
+        low = number & 0x000FFF
+        mid = number & 0xFFF000
+        number = (number ^ (low | mid)) | (low << 12) | (mid >> 12)
+
+        wobble = numpy.zeros_like(number)
+        nybble = numpy.full_like(number, -1)
+        columns = []
+        n = 0
+        while True:
+            active = (number != 0) | (nybble != 0) | (n < self.min_length)
+            if not active.any():
+                break
+            number, nybble = numpy.divmod(number, self.length)
+            index = (nybble + wobble) % self.length
+            wobble += index - n
+            columns.append(numpy.where(active, self.letters[index], 0))
+            n += 1
+
+        # Fixed-width byte strings drop their trailing zeros.
+        table = numpy.ascontiguousarray(numpy.stack(columns, axis=1), "uint8")
+        return [code.decode() for code in table.view(f"S{n}").ravel()]
+
+
+@functools.lru_cache(maxsize=64)
+def codec(alphabet: str, min_length: int = 7):
+    return Codec(alphabet, min_length)
+
+
 def encode(item_id: int, alphabet: str, min_length: int = 7):
-    if item_id < 0:
-        raise ValueError("Negative numbers cannot be encoded.", item_id)
-
-    length = len(alphabet)
-    letters = []
-    wobble = 0
-    number = twiddle(item_id)
-    nybble = -1
-    while number or nybble or len(letters) < min_length:
-        number, nybble = divmod(number, length)
-        index = (nybble + wobble) % length
-        wobble += index - len(letters)
-        letters.append(alphabet[index])
-    return "".join(letters)
+    return codec(alphabet, min_length).encode(item_id)
 
 
 def decode(code: str, alphabet: str, default=None):
-    length = len(alphabet)
-    number = 0
-    wobble = 0
-    multiplier = 1
-    valid = True
-    nybble = None
-    for n, letter in enumerate(code):
-        index = alphabet.find(letter)
-        if index < 0:
-            valid = False
-
-        nybble = (index - wobble) % length
-        wobble += index - n
-        number += nybble * multiplier
-        multiplier *= length
-
-    if valid and nybble == 0:
-        return twiddle(number)
-    return default
+    return codec(alphabet).decode(code, default)
+
+
+def encode_many(item_ids, alphabet: str, min_length: int = 7):
+    return codec(alphabet, min_length).encode_many(item_ids)
+
+
+def decode_many(codes, alphabet: str, default=None):
+    return codec(alphabet).decode_many(codes, default)
@@ -0,0 +1,107 @@
+import time
+
+import widgets.metrics
+
+purged_widgets = widgets.metrics.Counter(
+    "widgets_maintenance_purged_total",
+    "Deleted widgets removed for good by maintenance.")
+reclaimed_bytes = widgets.metrics.Counter(
+    "widgets_maintenance_reclaimed_bytes_total",
+    "Free database space handed back by maintenance.")
+maintenance_seconds = widgets.metrics.Histogram(
+    "widgets_maintenance_seconds",
+    "Time spent on each round of database maintenance.",
+    buckets=(0.01, 0.1, 1.0, 10.0, 60.0, 600.0))
+
+# Deleted widgets removed per statement.  Each batch goes through the write
+# queue like any other write, so requests never wait long behind one.
+PURGE_BATCH_SIZE = 500
+
+# Free pages handed back per step, each in its own short transaction.
+VACUUM_BATCH_PAGES = 256
+
+# Rows ANALYZE reads from each index.  Rough statistics are plenty for the
+# query planner, and this keeps ANALYZE from holding the write lock long.
+ANALYSIS_LIMIT = 1000
+
+
+async def pragma(db, name):
+    async with db.execute(f"PRAGMA {name}") as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+
+async def purge_deleted(database, cutoff):
+    # Removes widgets deleted before the cutoff.  The widget with the
+    # largest id in each database stays, deleted or not, since new ids
+    # start above it.  That keeps the largest id of all, too, so none of
+    # the databases can go back to handing out ids already used.
+    query = """
+        DELETE FROM widgets
+        WHERE id IN (
+            SELECT id
+            FROM widgets
+            WHERE deleted IS NOT NULL AND deleted < ?
+            AND id < (SELECT MAX(id) FROM widgets)
+            LIMIT ?
+        )
+    """
+    purged = 0
+    while True:
+        result = await database.write(query, (cutoff, PURGE_BATCH_SIZE))
+        purged += result.rowcount
+        purged_widgets.inc(amount=result.rowcount)
+        if result.rowcount < PURGE_BATCH_SIZE:
+            return purged
+
+
+async def vacuum(database):
+    # Hands free pages back to the filesystem, a few at a time, and returns
+    # how many bytes that came to.  Databases created before incremental
+    # vacuuming need a full VACUUM once before this can do anything.
+    async with database.connect(write=True) as db:
+        if await pragma(db, "auto_vacuum") != 2:
+            return 0
+        page_size = await pragma(db, "page_size")
+        free = await pragma(db, "freelist_count")
+
+    reclaimed = 0
+    while free:
+        async with database.connect(write=True) as db:
+            query = f"PRAGMA incremental_vacuum({VACUUM_BATCH_PAGES})"
+            async with db.execute(query) as cursor:
+                await cursor.fetchall()
+            remaining = await pragma(db, "freelist_count")
+        if remaining >= free:
+            break
+        reclaimed += (free - remaining) * page_size
+        free = remaining
+
+    reclaimed_bytes.inc(amount=reclaimed)
+    return reclaimed
+
+
+async def analyze(database):
+    async with database.connect(write=True) as db:
+        await db.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        await db.execute("ANALYZE")
+        await db.commit()
+
+    # Other connections only read the statistics when they open.
+    await database.readers.recycle()
+    await database.writers.recycle()
+
+
+async def run_maintenance(dbmanager, retention):
+    started = time.perf_counter()
+    cutoff = dbmanager.now() - int(retention * 1000000)
+    purged = reclaimed = 0
+    for database in dbmanager.databases:
+        purged += await purge_deleted(database, cutoff)
+        reclaimed += await vacuum(database)
+        await analyze(database)
+    elapsed = time.perf_counter() - started
+    maintenance_seconds.observe(elapsed)
+    print(f"Maintenance: purged {purged} deleted widgets, "
+          f"reclaimed {reclaimed} bytes in {elapsed:.2f}s")
+    return purged, reclaimed
@@ -0,0 +1,138 @@
+import bisect
+
+import tornado.web
+
+# Every metric registers itself here, by name, as it's created.
+metrics = {}
+
+# Request and query latencies, in seconds.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def escape(value):
+    return (str(value).replace("\\", r"\\").replace('"', r'\"')
+            .replace("\n", r"\n"))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"'
+                          for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        metrics[name] = self
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for labels, value in sorted(self.values.items()):
+            names = format_labels(self.labels, labels)
+            lines.append(f"{self.name}{names} {format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class CallbackMetric(Metric):
+    # Asks a function for its current values each time it gets rendered,
+    # for things that already keep their own counts.
+    def __init__(self, name, documentation, kind, function, labels=()):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.function = function
+
+    def render(self):
+        lines = self.header()
+        for labels, value in sorted(self.function().items()):
+            names = format_labels(self.labels, labels)
+            lines.append(f"{self.name}{names} {format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        # Counts land in only their own bucket here; render() adds them up.
+        series = self.values.get(labels)
+        if series is None:
+            counts = [0] * (len(self.buckets) + 1)
+            series = self.values[labels] = [counts, 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = self.header()
+        bounds = self.buckets + (float("inf"),)
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                names = format_labels(self.labels, labels,
+                                      [("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{names} {cumulative}")
+            names = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{names} {format_value(total)}")
+            lines.append(f"{self.name}_count{names} {cumulative}")
+        return lines
+
+
+def render():
+    lines = []
+    for name in sorted(metrics):
+        lines.extend(metrics[name].render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(render())
@@ -1,3 +1,5 @@
+from widgets.database import format_time
+
 migrations = []
 
 
@@ -64,30 +66,389 @@ async def create_alphabets_table(db):
     """)
 
 
-async def run_migrations(dbmanager):
-    async with dbmanager.connect() as db:
-        await db.execute(r"""
-            CREATE TABLE IF NOT EXISTS migrations (
-                name TEXT PRIMARY KEY,
-                migrated TEXT NOT NULL
-            )
+@migration
+async def index_widgets_by_account(db):
+    await db.execute(r"""
+        CREATE INDEX widgets_by_account
+        ON widgets (account_id, deleted, id)
+    """)
+
+
+@migration
+async def track_account_versions(db):
+    # Every change to an account's widgets bumps its version number, which
+    # serves as the Etag for its widget listings.
+    await db.execute(r"""
+        CREATE TABLE account_versions (
+            account_id INTEGER NOT NULL PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    await fill_account_versions(db)
+    await create_version_triggers(db)
+
+
+async def fill_account_versions(db):
+    await db.execute(r"""
+        INSERT INTO account_versions (account_id, version)
+        SELECT account_id, 1 FROM widgets GROUP BY account_id
+    """)
+
+
+async def create_version_triggers(db):
+    events = [("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")]
+    for event, row in events:
+        await db.execute(rf"""
+            CREATE TRIGGER widgets_{event.lower()}_version
+            AFTER {event} ON widgets
+            BEGIN
+                INSERT OR IGNORE INTO account_versions (account_id, version)
+                VALUES ({row}.account_id, 0);
+                UPDATE account_versions SET version = version + 1
+                WHERE account_id = {row}.account_id;
+            END
+        """)
+
+
+def epoch_micros(column):
+    # Converts the text of a timestamp, as str(datetime) wrote it, to
+    # microseconds since the epoch.  Microseconds are left off when zero.
+    return (f"CAST(strftime('%s', {column}) AS INTEGER) * 1000000"
+            f" + CASE WHEN substr({column}, 20, 1) = '.'"
+            f" THEN CAST(substr({column}, 21, 6) AS INTEGER) ELSE 0 END")
+
+
+@migration
+async def compact_timestamps(db):
+    # Timestamps become integer microseconds since the epoch, and the
+    # tables become STRICT, so SQLite keeps them that way.  SQLite can't
+    # change column types in place, so each table gets rebuilt.
+    await db.execute(r"""
+        CREATE TABLE accounts_new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL,
+            created INTEGER NOT NULL,
+            updated INTEGER NOT NULL
+        ) STRICT
+    """)
+    await db.execute(rf"""
+        INSERT INTO accounts_new (id, name, created, updated)
+        SELECT id, name, {epoch_micros("created")}, {epoch_micros("updated")}
+        FROM accounts
+    """)
+
+    await db.execute(r"""
+        CREATE TABLE tokens_new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            account_id INTEGER NOT NULL,
+            token TEXT NOT NULL UNIQUE,
+            created INTEGER NOT NULL,
+            updated INTEGER NOT NULL
+        ) STRICT
+    """)
+    await db.execute(rf"""
+        INSERT INTO tokens_new (id, account_id, token, created, updated)
+        SELECT id, account_id, token,
+            {epoch_micros("created")}, {epoch_micros("updated")}
+        FROM tokens
+    """)
+
+    await db.execute(r"""
+        CREATE TABLE widgets_new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            account_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            parts INTEGER NOT NULL,
+            created INTEGER NOT NULL,
+            updated INTEGER NOT NULL,
+            description TEXT,
+            deleted INTEGER DEFAULT NULL
+        ) STRICT
+    """)
+    await db.execute(rf"""
+        INSERT INTO widgets_new (id, account_id, name, parts,
+            created, updated, description, deleted)
+        SELECT id, account_id, name, parts,
+            {epoch_micros("created")}, {epoch_micros("updated")},
+            description, {epoch_micros("deleted")}
+        FROM widgets
+    """)
+
+    # Dropping the old tables drops their indexes and triggers as well.
+    for table in ["accounts", "tokens", "widgets"]:
+        await db.execute(f"DROP TABLE {table}")
+        await db.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    await db.execute(r"""
+        CREATE INDEX widgets_by_account
+        ON widgets (account_id, deleted, id)
+    """)
+    await create_version_triggers(db)
+
+
+@migration
+async def index_deleted_widgets(db):
+    # Lets maintenance find old deleted widgets without reading the rest.
+    await db.execute(r"""
+        CREATE INDEX widgets_by_deleted
+        ON widgets (deleted)
+        WHERE deleted IS NOT NULL
+    """)
+
+
+@migration
+async def track_account_totals(db):
+    # Keeps each account's live widget count, total parts, and latest
+    # change up to date, so reading them never has to scan the widgets.
+    await db.execute(r"""
+        CREATE TABLE account_totals (
+            account_id INTEGER NOT NULL PRIMARY KEY,
+            widgets INTEGER NOT NULL,
+            parts INTEGER NOT NULL,
+            updated INTEGER
+        ) STRICT
+    """)
+    await fill_account_totals(db)
+
+    # Widgets count while they aren't deleted, so an update subtracts the
+    # old row's share and adds the new one's.  Purging a deleted widget
+    # changes nothing.  Updates only matter when they touch the columns
+    # counted here, and not, say, when another trigger records the change.
+    live = "CASE WHEN {0}.deleted IS NULL THEN {1} ELSE 0 END"
+    changes = {
+        "insert": ("INSERT", "NEW", f"""
+            widgets = widgets + {live.format("NEW", 1)},
+            parts = parts + {live.format("NEW", "NEW.parts")},
+            updated = max(coalesce(updated, 0), NEW.updated)
+        """),
+        "update": ("UPDATE OF parts, deleted, updated", "NEW", f"""
+            widgets = widgets - {live.format("OLD", 1)}
+                + {live.format("NEW", 1)},
+            parts = parts - {live.format("OLD", "OLD.parts")}
+                + {live.format("NEW", "NEW.parts")},
+            updated = max(coalesce(updated, 0), NEW.updated)
+        """),
+        "delete": ("DELETE", "OLD", f"""
+            widgets = widgets - {live.format("OLD", 1)},
+            parts = parts - {live.format("OLD", "OLD.parts")}
+        """),
+    }
+    for name, (event, row, settings) in changes.items():
+        await db.execute(rf"""
+            CREATE TRIGGER widgets_{name}_totals
+            AFTER {event} ON widgets
+            BEGIN
+                INSERT OR IGNORE INTO account_totals
+                    (account_id, widgets, parts, updated)
+                VALUES ({row}.account_id, 0, 0, NULL);
+                UPDATE account_totals SET {settings}
+                WHERE account_id = {row}.account_id;
+            END
         """)
 
-        async with db.execute("SELECT name FROM migrations") as cursor:
-            migrated = set(row[0] for row in await cursor.fetchall())
-        print(f"Checking migrations: {len(migrated)} / {len(migrations)} ...")
 
-        updated = []
-        for migration in migrations:
-            name = migration.__name__
-            if name not in migrated:
-                print(f"Running migration {name}...")
+async def fill_account_totals(db):
+    await db.execute(r"""
+        INSERT INTO account_totals (account_id, widgets, parts, updated)
+        SELECT account_id,
+            SUM(deleted IS NULL),
+            SUM(CASE WHEN deleted IS NULL THEN parts ELSE 0 END),
+            MAX(updated)
+        FROM widgets
+        GROUP BY account_id
+    """)
+
+
+@migration
+async def search_widgets(db):
+    # A full-text index of the names and descriptions of widgets that
+    # aren't deleted.  It keeps no copy of the text, only the index, so the
+    # triggers have to remove entries using the old values.  Each entry is
+    # tagged with its account, so a search only looks at that account's.
+    await db.execute(r"""
+        CREATE VIRTUAL TABLE widget_search USING fts5(
+            account, name, description,
+            content='', prefix='2 3'
+        )
+    """)
+    await db.execute(r"""
+        INSERT INTO widget_search (widget_search, rank)
+        VALUES ('rank', 'bm25(0.0, 2.0, 1.0)')
+    """)
+    await fill_widget_search(db)
+
+    add = """
+        INSERT INTO widget_search (rowid, account, name, description)
+        SELECT NEW.id, 'a' || NEW.account_id, NEW.name, NEW.description
+        WHERE NEW.deleted IS NULL;
+    """
+    remove = """
+        INSERT INTO widget_search
+            (widget_search, rowid, account, name, description)
+        SELECT 'delete', OLD.id, 'a' || OLD.account_id,
+            OLD.name, OLD.description
+        WHERE OLD.deleted IS NULL;
+    """
+    events = [
+        ("insert", "INSERT", add),
+        ("update", "UPDATE OF name, description, deleted", remove + add),
+        ("delete", "DELETE", remove),
+    ]
+    for name, event, body in events:
+        await db.execute(rf"""
+            CREATE TRIGGER widgets_{name}_search
+            AFTER {event} ON widgets
+            BEGIN
+                {body}
+            END
+        """)
+
+
+async def fill_widget_search(db):
+    await db.execute(r"""
+        INSERT INTO widget_search (rowid, account, name, description)
+        SELECT id, 'a' || account_id, name, description
+        FROM widgets
+        WHERE deleted IS NULL
+    """)
+
+
+@migration
+async def track_widget_changes(db):
+    # Each widget keeps the account version its latest change got.  Versions
+    # go up in the order changes are committed, whatever the clock said when
+    # they were stamped, so sync cursors can follow them without skipping
+    # a slow write.
+    await db.execute(r"""
+        ALTER TABLE widgets
+        ADD COLUMN change INTEGER NOT NULL DEFAULT 0
+    """)
+    for event in ("insert", "update", "delete"):
+        await db.execute(f"DROP TRIGGER widgets_{event}_version")
+
+    # Number the widgets already here in the order they last changed,
+    # after any version already handed out as an Etag.
+    await db.execute(r"""
+        INSERT OR IGNORE INTO account_versions (account_id, version)
+        SELECT DISTINCT account_id, 0 FROM widgets
+    """)
+    await db.execute(r"""
+        UPDATE widgets SET change = ranked.change
+        FROM (
+            SELECT widgets.id, account_versions.version + ROW_NUMBER()
+                OVER (PARTITION BY widgets.account_id
+                      ORDER BY MAX(widgets.updated,
+                                   IFNULL(widgets.deleted, 0)),
+                               widgets.id) AS change
+            FROM widgets
+            JOIN account_versions USING (account_id)
+        ) AS ranked
+        WHERE widgets.id = ranked.id
+    """)
+    await db.execute(r"""
+        UPDATE account_versions SET version = (
+            SELECT MAX(change) FROM widgets
+            WHERE widgets.account_id = account_versions.account_id
+        )
+        WHERE account_id IN (SELECT account_id FROM widgets)
+    """)
+
+    await create_change_triggers(db)
+    await db.execute(r"""
+        CREATE INDEX widgets_by_change
+        ON widgets (account_id, change)
+    """)
+
+
+async def create_change_triggers(db):
+    # Setting the change column mustn't count as another change, so the
+    # update trigger watches every other column.
+    columns = ("id, account_id, name, parts, created, updated, description, "
+               "deleted")
+    record = """
+        UPDATE widgets SET change = (
+            SELECT version FROM account_versions
+            WHERE account_id = NEW.account_id
+        )
+        WHERE id = NEW.id;
+    """
+    events = [
+        ("insert", "INSERT", "NEW", record),
+        ("update", f"UPDATE OF {columns}", "NEW", record),
+        ("delete", "DELETE", "OLD", ""),
+    ]
+    for name, event, row, body in events:
+        await db.execute(rf"""
+            CREATE TRIGGER widgets_{name}_version
+            AFTER {event} ON widgets
+            BEGIN
+                INSERT OR IGNORE INTO account_versions (account_id, version)
+                VALUES ({row}.account_id, 0);
+                UPDATE account_versions SET version = version + 1
+                WHERE account_id = {row}.account_id;
+                {body}
+            END
+        """)
+
+
+async def schema_version(db):
+    async with db.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+
+async def run_migrations(dbmanager):
+    # Every database gets the same schema, even though the primary has no
+    # widgets and the shards have no accounts.
+    updated = []
+    for database in dbmanager.databases:
+        for name in await migrate_database(dbmanager, database):
+            if name not in updated:
                 updated.append(name)
-                await migration(db)
-                await db.execute(r"""
-                    INSERT INTO migrations (name, migrated) VALUES (?, ?)
-                """, (name, str(dbmanager.now())))
-                await db.commit()
+    return updated
+
+
+async def migrate_database(dbmanager, database):
+    async with database.connect(write=True) as db:
+        # Up-to-date databases, the usual case, need only this one read.
+        if await schema_version(db) == len(migrations):
+            print(f"Migrations current: {len(migrations)}")
+            return []
+
+        # Everything pending goes in together, or not at all.  The lock
+        # also makes other processes wait until this one is finished.
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await db.execute(r"""
+                CREATE TABLE IF NOT EXISTS migrations (
+                    name TEXT PRIMARY KEY,
+                    migrated TEXT NOT NULL
+                )
+            """)
+
+            async with db.execute("SELECT name FROM migrations") as cursor:
+                migrated = set(row[0] for row in await cursor.fetchall())
+            print(f"Checking migrations: "
+                  f"{len(migrated)} / {len(migrations)} ...")
+
+            updated = []
+            for migration in migrations:
+                name = migration.__name__
+                if name not in migrated:
+                    print(f"Running migration {name}...")
+                    updated.append(name)
+                    await migration(db)
+                    await db.execute(r"""
+                        INSERT INTO migrations (name, migrated)
+                        VALUES (?, ?)
+                    """, (name, format_time(dbmanager.now())))
+
+            # PRAGMA values can't be bound as parameters.
+            await db.execute(f"PRAGMA user_version = {len(migrations)}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
 
         print("Migrations complete.")
         return updated
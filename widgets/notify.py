@@ -0,0 +1,90 @@
+import asyncio
+import collections
+import uuid
+
+
+# Passes each account's widget changes along to everyone in this process
+# who is listening for them, and keeps the latest few around for clients
+# that poll in between.  Sequence numbers start over with each process, so
+# cursors carry a boot id as well, to tell one process's apart from another.
+class Notifier:
+    def __init__(self, history=1000):
+        self.boot = uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self.recent = collections.deque(maxlen=history)
+        self.listeners = collections.defaultdict(set)
+
+    def publish(self, account_id, event):
+        # Call this only once the change has been committed.
+        self.sequence += 1
+        event = dict(event, seq=self.sequence)
+        self.recent.append((account_id, event))
+        for listener in list(self.listeners.get(account_id, ())):
+            listener(event)
+        return event
+
+    def subscribe(self, account_id, listener):
+        self.listeners[account_id].add(listener)
+
+    def unsubscribe(self, account_id, listener):
+        listeners = self.listeners.get(account_id)
+        if listeners is not None:
+            listeners.discard(listener)
+            if not listeners:
+                del self.listeners[account_id]
+
+    def cursor(self, sequence=None):
+        if sequence is None:
+            sequence = self.sequence
+        return f"{self.boot}:{sequence}"
+
+    def parse_cursor(self, cursor):
+        # The sequence number, or None if the cursor came from some other
+        # process, whose numbers mean nothing here.  Raises ValueError if it
+        # isn't a cursor at all.
+        boot, colon, sequence = cursor.rpartition(":")
+        if not sequence.isdecimal():
+            raise ValueError(cursor)
+        if boot != self.boot:
+            return None
+        return int(sequence)
+
+    def listener_count(self):
+        return sum(len(listeners) for listeners in self.listeners.values())
+
+    def events_after(self, account_id, after):
+        # None means some of them are gone, so the client has to catch up
+        # some other way.
+        if after > self.sequence:
+            return None
+        if self.recent and self.recent[0][1]["seq"] > after + 1:
+            return None
+
+        events = []
+        for account, event in reversed(self.recent):
+            if event["seq"] <= after:
+                break
+            if account == account_id:
+                events.append(event)
+        events.reverse()
+        return events
+
+    async def wait(self, account_id, after, timeout):
+        events = self.events_after(account_id, after)
+        if events is None or events:
+            return events
+
+        arrived = asyncio.get_event_loop().create_future()
+
+        def listener(event):
+            if not arrived.done():
+                arrived.set_result(None)
+
+        self.subscribe(account_id, listener)
+        try:
+            await asyncio.wait_for(arrived, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.unsubscribe(account_id, listener)
+        return self.events_after(account_id, after)
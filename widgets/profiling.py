@@ -0,0 +1,173 @@
+import cProfile
+import collections
+import hmac
+import os
+import pstats
+import random
+
+import widgets.metrics
+
+profiled_requests = widgets.metrics.Counter(
+    "widgets_profiled_requests_total",
+    "Requests run under the profiler, by handler and method.",
+    ["handler", "method"])
+
+# Asks for this request to be profiled, given the secret from the command
+# line, whatever the sampling rate.
+PROFILE_HEADER = "X-Widgets-Profile"
+
+# Calls below this share of a microsecond get left out of the stacks.
+MIN_STACK_TIME = 0.5
+
+
+def profiled(coroutine, profile):
+    # Steps through the coroutine by hand, profiling only while it runs, so
+    # whatever other requests do while this one waits doesn't count.
+    value = None
+    error = None
+    while True:
+        profile.enable()
+        try:
+            if error is None:
+                yielded = coroutine.send(value)
+            else:
+                yielded = coroutine.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profile.disable()
+
+        try:
+            value = yield yielded
+            error = None
+        except BaseException as caught:
+            value = None
+            error = caught
+
+
+class ProfiledCall:
+    def __init__(self, coroutine, profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        return profiled(self.coroutine, self.profile)
+
+
+def frame_label(func):
+    filename, line, name = func
+    if filename == "~":
+        # Built-in functions, such as "<method 'execute' of ...>".
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ":")
+
+
+def collapse_stacks(stats):
+    # Flame graphs want whole stacks, but cProfile only keeps each caller
+    # and callee pair, so this splits the time spent in each function among
+    # its callers in proportion to their calls.  Good enough to see where
+    # the time goes; rather less so for functions called from everywhere.
+    callees = collections.defaultdict(list)
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if not any(caller in stats for caller in callers):
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees[caller].append((func, edge[3]))
+
+    stacks = collections.Counter()
+
+    def walk(stack, func, scale):
+        cc, nc, tt, ct, callers = stats[func]
+        stack = stack + [frame_label(func)]
+        own = tt * scale * 1000000
+        if own >= MIN_STACK_TIME:
+            stacks[";".join(stack)] += own
+        for callee, time in callees.get(func, ()):
+            total = stats[callee][3]
+            share = scale * time / total if total else 0
+            if total * share * 1000000 >= MIN_STACK_TIME:
+                if frame_label(callee) not in stack:
+                    walk(stack, callee, share)
+
+    for func in roots:
+        walk([], func, 1.0)
+    return [f"{stack} {round(time)}\n"
+            for stack, time in sorted(stacks.items()) if round(time)]
+
+
+class Profiler:
+    # Runs a sample of requests under cProfile, gathering a profile for each
+    # handler and method, and writes them out as pstats files along with
+    # collapsed stacks for flame graph tools, in microseconds.
+    def __init__(self, directory, rate=0.0, secret=None, name=None):
+        self.directory = directory
+        self.rate = rate
+        self.secret = secret
+        self.name = name
+        self.profiles = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def sampled(self, request):
+        requested = request.headers.get(PROFILE_HEADER)
+        if requested is not None and self.secret:
+            # compare_digest only takes ASCII strings, so compare the bytes.
+            # Tornado decodes headers as latin-1, which gets them back.
+            try:
+                matched = hmac.compare_digest(requested.encode("latin-1"),
+                                              self.secret.encode())
+            except UnicodeError:
+                matched = False
+            if matched:
+                return True
+        return random.random() < self.rate
+
+    def attach(self, handler):
+        # Swaps in a profiled version of the handler's method for this one
+        # request, if it's one of the chosen few.
+        request = handler.request
+        method = getattr(handler, request.method.lower(), None)
+        if method is None or not self.sampled(request):
+            return
+
+        key = (type(handler).__name__, request.method)
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = cProfile.Profile()
+        profiled_requests.inc(*key)
+
+        def run(*args, **kwargs):
+            profile.enable()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                profile.disable()
+            if result is not None and hasattr(result, "send"):
+                result = ProfiledCall(result, profile)
+            return result
+
+        setattr(handler, request.method.lower(), run)
+
+    def filename(self, key, extension):
+        parts = list(key)
+        if self.name:
+            parts.append(self.name)
+        return os.path.join(self.directory, ".".join(parts) + extension)
+
+    def write(self):
+        # Each file is replaced whole, so nobody reads one half written.
+        for key, profile in list(self.profiles.items()):
+            stats = pstats.Stats(profile)
+            if not stats.stats:
+                continue
+
+            filename = self.filename(key, ".pstats")
+            stats.dump_stats(filename + ".tmp")
+            os.replace(filename + ".tmp", filename)
+
+            filename = self.filename(key, ".collapsed")
+            with open(filename + ".tmp", "w") as output:
+                output.writelines(collapse_stacks(stats.stats))
+            os.replace(filename + ".tmp", filename)
@@ -0,0 +1,252 @@
+import asyncio
+import collections
+import json
+
+import aiosqlite
+
+import widgets.maintenance
+import widgets.migrations
+
+
+class TransferError(Exception):
+    pass
+
+
+# The kinds of record in an export, each with its table and columns, the
+# first of which orders them.  Ids go along unchanged, so with the alphabets
+# alongside them, the codes the API hands out stay the same after an import.
+# So do the account versions, so Etags handed out before still mean the
+# same listings.
+RECORDS = [
+    ("alphabet", "alphabets", ["id", "prefix", "alphabet"]),
+    ("account", "accounts", ["id", "name", "created", "updated"]),
+    ("token", "tokens", ["id", "account_id", "token", "created", "updated"]),
+    ("widget", "widgets", ["id", "account_id", "name", "parts", "created",
+                           "updated", "description", "deleted", "change"]),
+    ("version", "account_versions", ["account_id", "version"]),
+]
+
+# Kinds of record that go in their account's own database.
+SHARDED_RECORDS = {"widget", "version"}
+
+# Rows fetched from a cursor at a time while exporting.
+EXPORT_BATCH_SIZE = 1000
+
+# Rows inserted per statement, and per transaction, while importing.
+IMPORT_BATCH_SIZE = 10000
+IMPORT_COMMIT_ROWS = 500000
+
+
+def encode_record(record):
+    return json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+
+async def export_records(dbmanager, output):
+    # Writes every record out as a line of JSON, a batch of rows at a time,
+    # so memory use stays flat however big the databases get.  Each one is
+    # read in a single transaction, as of a single moment, while the server
+    # carries on writing to it.
+    version = len(widgets.migrations.migrations)
+    output.write(encode_record({"type": "export", "version": version}))
+
+    exported = 0
+    for database in dbmanager.databases:
+        async with database.connect() as db:
+            if await widgets.migrations.schema_version(db) != version:
+                raise TransferError(f"{database.target} needs migrating.")
+
+            await db.execute("BEGIN")
+            try:
+                for kind, table, fields in RECORDS:
+                    query = f"""
+                        SELECT {', '.join(fields)}
+                        FROM {table}
+                        ORDER BY {fields[0]}
+                    """
+                    async with db.execute(query) as cursor:
+                        while True:
+                            rows = await cursor.fetchmany(EXPORT_BATCH_SIZE)
+                            if not rows:
+                                break
+                            for row in rows:
+                                record = {"type": kind}
+                                record.update(zip(fields, row))
+                                output.write(encode_record(record))
+                            exported += len(rows)
+            finally:
+                await db.rollback()
+    return exported
+
+
+def parse_record(number, line):
+    try:
+        record = json.loads(line.decode())
+        kind = record.pop("type")
+    except (ValueError, TypeError, AttributeError, KeyError):
+        raise TransferError(f"Line {number} is not an export record.")
+    return kind, record
+
+
+async def check_empty(database):
+    # Ids from the export would clash with any already here.
+    async with database.connect() as db:
+        for table in ("accounts", "widgets"):
+            query = f"SELECT 1 FROM {table} LIMIT 1"
+            async with db.execute(query) as cursor:
+                if await cursor.fetchone():
+                    raise TransferError(
+                        f"{database.target} already has {table}.")
+
+
+async def defer_schema(db, deferred):
+    # Drops the indexes and triggers on the widgets table, keeping the
+    # statements that put them back.  Building each index once at the end
+    # beats updating it a row at a time, and the tables the triggers keep
+    # up to date can be filled in all at once afterwards.
+    query = """
+        SELECT type, name, sql
+        FROM sqlite_master
+        WHERE tbl_name = 'widgets' AND type IN ('index', 'trigger')
+        AND sql IS NOT NULL
+    """
+    async with db.execute(query) as cursor:
+        rows = await cursor.fetchall()
+    for kind, name, sql in rows:
+        await db.execute(f"DROP {kind.upper()} {name}")
+        deferred.append(sql)
+
+
+async def restore_versions(db):
+    # Versions have to stay ahead of every change, or the next one would be
+    # numbered like one already made.  Exports from before versions came
+    # along have none, so those start from each account's latest change.
+    await db.execute("""
+        INSERT INTO account_versions (account_id, version)
+        SELECT account_id, MAX(change) FROM widgets WHERE true
+        GROUP BY account_id
+        ON CONFLICT (account_id)
+        DO UPDATE SET version = MAX(version, excluded.version)
+    """)
+
+
+async def restore_schema(db, statements):
+    for sql in statements:
+        await db.execute(sql)
+    await restore_versions(db)
+    await widgets.migrations.fill_account_totals(db)
+    await widgets.migrations.fill_widget_search(db)
+    await db.commit()
+
+
+async def insert_rows(db, query, rows):
+    try:
+        await db.executemany(query, rows)
+    except aiosqlite.Error as error:
+        raise TransferError(f"Import failed: {error}")
+
+
+async def import_records(dbmanager, lines):
+    # Loads an export into empty databases, which needn't have the same
+    # number of shards as the ones it came from.  If this fails part way,
+    # start over with fresh databases.
+    await widgets.migrations.run_migrations(dbmanager)
+    for database in dbmanager.databases:
+        await check_empty(database)
+
+    lines = iter(lines)
+    kind, header = parse_record(1, next(lines, b"null"))
+    version = len(widgets.migrations.migrations)
+    if kind != "export" or header.get("version") != version:
+        raise TransferError(f"Only exports from schema version {version} "
+                            f"can be imported.")
+
+    inserts = {}
+    columns = {}
+    for kind, table, fields in RECORDS:
+        columns[kind] = fields
+        inserts[kind] = f"""
+            INSERT INTO {table} ({', '.join(fields)})
+            VALUES ({', '.join('?' for field in fields)})
+        """
+
+    connections = []
+    deferred = []
+    writing = []
+    try:
+        for database in dbmanager.databases:
+            db = await database.writers.acquire()
+            connections.append(db)
+            deferred.append([])
+            writing.append(None)
+            # A failed import has to start over anyway, so there's no need
+            # to wait for each commit to reach the disk.
+            await db.execute("PRAGMA synchronous = OFF")
+            await defer_schema(db, deferred[-1])
+
+        # Whatever alphabets are here encode nothing yet, and the ones in
+        # the export are what its ids were handed out with.
+        await connections[0].execute("DELETE FROM alphabets")
+
+        pending = collections.defaultdict(list)
+        uncommitted = [0] * len(connections)
+        imported = 0
+        for number, line in enumerate(lines, 2):
+            if not line.strip():
+                continue
+            kind, record = parse_record(number, line)
+            if kind not in columns:
+                raise TransferError(f"Line {number} has an unknown type.")
+            try:
+                row = tuple(record[field] for field in columns[kind])
+            except KeyError as error:
+                raise TransferError(f"Line {number} has no {error.args[0]}.")
+
+            index = 0
+            if kind in SHARDED_RECORDS:
+                if not isinstance(record["account_id"], int):
+                    raise TransferError(f"Line {number} has a bad account.")
+                index = dbmanager.database(record["account_id"]).index
+
+            rows = pending[index, kind]
+            rows.append(row)
+            if len(rows) < IMPORT_BATCH_SIZE:
+                continue
+
+            # Each batch goes in on the database's own thread, while the
+            # next one gets parsed here.
+            db = connections[index]
+            if writing[index] is not None:
+                await writing[index]
+            writing[index] = asyncio.ensure_future(
+                insert_rows(db, inserts[kind], rows))
+            imported += len(rows)
+            uncommitted[index] += len(rows)
+            del pending[index, kind]
+            if uncommitted[index] >= IMPORT_COMMIT_ROWS:
+                await writing[index]
+                await db.commit()
+                uncommitted[index] = 0
+
+        for (index, kind), rows in pending.items():
+            await insert_rows(connections[index], inserts[kind], rows)
+            imported += len(rows)
+        for db, write in zip(connections, writing):
+            if write is not None:
+                await write
+            await db.commit()
+    finally:
+        await asyncio.gather(*[write for write in writing if write],
+                             return_exceptions=True)
+        # Put the indexes and triggers back, even after a failure, so the
+        # databases are still usable.
+        for database, db, statements in zip(dbmanager.databases,
+                                            connections, deferred):
+            try:
+                await db.rollback()
+                await restore_schema(db, statements)
+            finally:
+                await database.writers.release(db)
+
+    for database in dbmanager.databases:
+        await widgets.maintenance.analyze(database)
+    return imported
@@ -1,7 +1,103 @@
 import json
+import re
+
+import tornado.iostream
+from tornado.escape import json_encode
+
+from widgets.database import format_times
 
 import widgets.auth
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+MAX_BATCH_OPERATIONS = 5000
+MAX_SEARCH_TERMS = 16
+
+
+def check_name(name):
+    if not name:
+        return 'name is required'
+    elif not isinstance(name, str):
+        return 'name must be a string'
+    elif 64 < len(name):
+        return 'name must not be longer than 64 characters'
+
+
+def check_parts(parts):
+    if not parts:
+        return 'parts is required'
+    elif not isinstance(parts, int):
+        return 'parts must be an integer'
+    elif parts < 0:
+        return 'parts must not be negative'
+    elif (1 << 31) < parts:
+        return 'parts must not be excessively large'
+
+
+def check_description(description):
+    if description is not None and not isinstance(description, str):
+        return 'description must be a string'
+
+
+field_checks = {
+    "name": check_name,
+    "parts": check_parts,
+    "description": check_description,
+}
+
+
+def check_fields(post, current=None, partial=False):
+    # Partial checks only look at the fields in the post, and skip any that
+    # already match the current widget.
+    errors = {}
+    changes = {}
+    for field, check in field_checks.items():
+        if partial:
+            if field not in post:
+                continue
+            if current and post[field] == current[field]:
+                continue
+
+        value = post.get(field)
+        error = check(value)
+        if error:
+            errors[field] = error
+        else:
+            changes[field] = value
+
+    return changes, errors
+
+
+def search_terms(search):
+    # The words to look for; each matches any word that starts with it.
+    return re.findall(r"\w+", search)[:MAX_SEARCH_TERMS]
+
+
+def encode_sync_cursor(change):
+    return f"c{change}"
+
+
+def decode_sync_cursor(since):
+    # The last change seen, from an earlier sync.  Zero starts from the very
+    # beginning.  Cursors from before changes were numbered don't fit, so
+    # clients holding one have to start over.
+    if since == "0":
+        return 0
+    if not since.startswith("c") or not since[1:].isdecimal():
+        return None
+    return int(since[1:])
+
+
+def publish_change(handler, event, widget):
+    # Tells any clients listening for the account's changes.  Call this
+    # only after the change has been committed.
+    handler.dbmanager.notifier.publish(handler.account_id, {
+        'account': handler.account_code,
+        'event': event,
+        'widget': widget,
+    })
+
 
 class WidgetHandler(widgets.auth.AuthorizedRequestHandler):
     async def get(self):
@@ -10,28 +106,276 @@ class WidgetHandler(widgets.auth.AuthorizedRequestHandler):
             self.write({'error': 'Not Authorized'})
             return
 
+        errors = {}
+
+        limit = self.get_argument("limit", None)
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+        elif not limit.isdecimal():
+            errors['limit'] = 'limit must be a positive integer'
+        elif not 0 < int(limit) <= MAX_PAGE_SIZE:
+            errors['limit'] = f'limit must be between 1 and {MAX_PAGE_SIZE}'
+        else:
+            limit = int(limit)
+
+        after = self.get_argument("after", None)
+        after_id = 0
+        if after is not None:
+            prefix, after_id = await self.dbmanager.decode_id(after)
+            if after_id is None or prefix != "widget":
+                errors['after'] = 'after must be a widget id'
+
+        since = self.get_argument("since", None)
+        if since is not None:
+            since_key = decode_sync_cursor(since)
+            if since_key is None:
+                errors['since'] = 'since must be a sync cursor'
+
+        search = self.get_argument("search", None)
+        offset = self.get_argument("offset", "0")
+        if search is not None:
+            terms = search_terms(search)
+            if not terms:
+                errors['search'] = 'search must contain at least one word'
+            elif since is not None:
+                errors['search'] = 'search must not be used with since'
+            if not offset.isdecimal():
+                errors['offset'] = 'offset must be a non-negative integer'
+            else:
+                offset = int(offset)
+
+        stream = self.get_argument("stream", None)
+        if since is not None or search is not None:
+            mode = "search" if search is not None else "since"
+            if after is not None or stream is not None:
+                errors[mode] = f'{mode} must not be used with after or stream'
+        elif stream is None:
+            accept = self.request.headers.get("Accept", "")
+            if "application/x-ndjson" in accept:
+                stream = "ndjson"
+        if stream not in (None, "json", "ndjson"):
+            errors['stream'] = 'stream must be json or ndjson'
+
+        if errors:
+            self.set_status(400)
+            self.write({'error': errors})
+            return
+
+        if since is not None:
+            await self.sync_widgets(since_key, limit)
+            return
+
+        if search is not None:
+            await self.search_widgets(terms, offset, limit)
+            return
+
+        # The Accept header can pick NDJSON over the same URL.
+        self.set_header("Vary", "Accept")
+
+        if not stream:
+            cache_key = (limit, after_id)
+            cached = self.dbmanager.cached_listing(self.account_id, cache_key)
+            if cached is not None:
+                etag, body = cached
+                self.set_header("Etag", etag)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+                self.set_header("Content-Type",
+                                "application/json; charset=UTF-8")
+                self.write(body)
+                return
+
+        generation = self.dbmanager.listing_generations[self.account_id]
+
+        # Any change to the account's widgets changes its version, so a
+        # matching Etag means the client already has this listing.
+        version = await self.account_version()
+        etag = f'"{self.account_code}-{version}"'
+        if stream == "ndjson":
+            etag = f'"{self.account_code}-{version}-ndjson"'
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        if stream:
+            await self.stream_widgets(stream, after_id)
+            return
+
+        widgets = await self.list_widgets(after_id, limit + 1)
+
+        # One extra row tells us whether there's another page.
+        more = len(widgets) > limit
+        del widgets[limit:]
+
+        await self.encode_widget_ids(widgets)
+
+        result = {
+            'account': self.account_code,
+            'widgets': widgets,
+        }
+        if more:
+            result['next'] = widgets[-1]["id"]
+
+        body = json_encode(result).encode()
+        self.dbmanager.cache_listing(self.account_id, generation, cache_key,
+                                     etag, body)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(body)
+
+    async def account_version(self):
+        version = 0
+        async with self.dbmanager.connect(account_id=self.account_id) as db:
+            query = """
+                SELECT version
+                FROM account_versions
+                WHERE account_id = ?
+            """
+            async with db.execute(query, (self.account_id,)) as cursor:
+                async for row in cursor:
+                    version = row[0]
+        return version
+
+    async def encode_widget_ids(self, widgets):
+        widget_ids = [widget["id"] for widget in widgets]
+        codes = await self.dbmanager.encode_ids("widget", widget_ids)
+        for widget, code in zip(widgets, codes):
+            widget["id"] = code
+
+    async def list_widgets(self, after_id, limit):
         fields = ["id", "name", "parts", "created", "updated", "description"]
 
         widgets = []
-        async with self.dbmanager.connect() as db:
+        async with self.dbmanager.connect(account_id=self.account_id) as db:
+            # Walks the widgets_by_account index, starting after the cursor.
             query = f"""
                 SELECT {', '.join(fields)}
                 FROM widgets
-                WHERE account_id = ? AND deleted IS NULL
+                WHERE account_id = ? AND deleted IS NULL AND id > ?
+                ORDER BY id
+                LIMIT ?
             """
-            async with db.execute(query, (self.account_id,)) as cursor:
+            params = (self.account_id, after_id, limit)
+            async with db.execute(query, params) as cursor:
+                async for row in cursor:
+                    widgets.append(format_times(dict(zip(fields, row))))
+
+        return widgets
+
+    async def sync_widgets(self, since, limit):
+        # Every widget created, updated, deleted, or restored after the
+        # cursor, in the order they were committed, using the
+        # widgets_by_change index.  Deleted widgets come back with their
+        # deleted time set.
+        fields = ["id", "name", "parts", "created", "updated", "description",
+                  "deleted", "change"]
+
+        widgets = []
+        async with self.dbmanager.connect(account_id=self.account_id) as db:
+            query = f"""
+                SELECT {', '.join(fields)}
+                FROM widgets
+                WHERE account_id = ? AND change > ?
+                ORDER BY change
+                LIMIT ?
+            """
+            params = (self.account_id, since, limit + 1)
+            async with db.execute(query, params) as cursor:
                 async for row in cursor:
                     widgets.append(dict(zip(fields, row)))
 
-        encoder = self.dbmanager.encode_id
+        more = len(widgets) > limit
+        del widgets[limit:]
+
+        cursor = since
+        if widgets:
+            cursor = widgets[-1]["change"]
         for widget in widgets:
-            widget["id"] = await encoder("widget", widget["id"])
+            del widget["change"]
+            format_times(widget)
+        await self.encode_widget_ids(widgets)
 
         self.write({
             'account': self.account_code,
             'widgets': widgets,
+            'since': encode_sync_cursor(cursor),
+            'more': more,
         })
 
+    async def search_widgets(self, terms, offset, limit):
+        # Best matches first.  Only widgets that aren't deleted are in the
+        # index, and the account tag keeps the search to this account's.
+        fields = ["id", "name", "parts", "created", "updated", "description"]
+        words = ' '.join(f'"{term}"*' for term in terms)
+        match = (f'account : "a{self.account_id}"'
+                 f' AND {{name description}} : ({words})')
+
+        widgets = []
+        async with self.dbmanager.connect(account_id=self.account_id) as db:
+            query = f"""
+                SELECT {', '.join(f'widgets.{field}' for field in fields)}
+                FROM widget_search
+                JOIN widgets ON widgets.id = widget_search.rowid
+                WHERE widget_search MATCH ? AND widgets.account_id = ?
+                ORDER BY widget_search.rank
+                LIMIT ? OFFSET ?
+            """
+            params = (match, self.account_id, limit + 1, offset)
+            async with db.execute(query, params) as cursor:
+                async for row in cursor:
+                    widgets.append(format_times(dict(zip(fields, row))))
+
+        more = len(widgets) > limit
+        del widgets[limit:]
+        await self.encode_widget_ids(widgets)
+
+        result = {
+            'account': self.account_code,
+            'widgets': widgets,
+        }
+        if more:
+            result['next'] = offset + limit
+        self.write(result)
+
+    async def stream_widgets(self, stream, after_id):
+        # Sends every widget after the cursor, one batch at a time.  Each
+        # batch is its own short query, so a slow client holds neither a
+        # pooled connection nor a read transaction while it catches up.
+        if stream == "ndjson":
+            self.set_header("Content-Type", "application/x-ndjson")
+            separator = "\n"
+        else:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            account = json_encode(self.account_code)
+            self.write(f'{{"account": {account}, "widgets": [')
+            separator = ", "
+
+        first = True
+        while True:
+            widgets = await self.list_widgets(after_id, STREAM_BATCH_SIZE)
+            if not widgets:
+                break
+
+            after_id = widgets[-1]["id"]
+            await self.encode_widget_ids(widgets)
+            for widget in widgets:
+                if stream == "ndjson":
+                    self.write(json_encode(widget) + separator)
+                elif first:
+                    self.write(json_encode(widget))
+                else:
+                    self.write(separator + json_encode(widget))
+                first = False
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                # The client went away; nobody is left to finish for.
+                return
+
+        if stream != "ndjson":
+            self.write("]}")
+
     async def post(self):
         if not self.account_id:
             self.set_status(401)
@@ -49,49 +393,23 @@ class WidgetHandler(widgets.auth.AuthorizedRequestHandler):
             self.write({'error': 'Invalid json request'})
             return
 
-        errors = {}
-
-        name = post.get("name")
-        if not name:
-            errors['name'] = 'name is required'
-        elif not isinstance(name, str):
-            errors['name'] = 'name must be a string'
-        elif 64 < len(name):
-            errors['name'] = 'name must not be longer than 64 characters'
-
-        parts = post.get("parts")
-        if not parts:
-            errors['parts'] = 'parts is required'
-        elif not isinstance(parts, int):
-            errors['parts'] = 'parts must be an integer'
-        elif parts < 0:
-            errors['parts'] = 'parts must not be negative'
-        elif (1 << 31) < parts:
-            errors['parts'] = 'parts must not be excessively large'
-
-        description = post.get("description")
-        if description is not None and not isinstance(description, str):
-            errors['description'] = 'description must be a string'
-
+        fields, errors = check_fields(post)
         if errors:
             self.set_status(400)
             self.write({'error': errors})
             return
 
         now = self.dbmanager.now()
-        fields = {
-            "name": name,
-            "parts": parts,
-            "description": description,
-            "created": str(now),
-            "updated": str(now),
-        }
+        fields["created"] = now
+        fields["updated"] = now
 
-        widget_id = await self.dbmanager.insert_row("widgets",
-                                                    account_id=self.account_id,
-                                                    **fields)
+        widget_id = await self.dbmanager.insert_widget(
+            account_id=self.account_id, **fields)
+        self.dbmanager.forget_listings(self.account_id)
 
+        format_times(fields)
         fields["id"] = await self.dbmanager.encode_id("widget", widget_id)
+        publish_change(self, "create", fields)
 
         self.write({
             'account': self.account_code,
@@ -116,80 +434,52 @@ class WidgetHandler(widgets.auth.AuthorizedRequestHandler):
             return
 
         errors = {}
-        changes = {}
 
         widget_code = post.get("id")
         if not widget_code:
             errors['id'] = 'id is required'
         else:
             prefix, widget_id = await self.dbmanager.decode_id(widget_code)
-            current = None
-            async with self.dbmanager.connect() as db:
-                fields = ["name", "parts", "description", "created"]
-                query = f"""
-                    SELECT {', '.join(fields)}
-                    FROM widgets
-                    WHERE id = ? AND account_id = ? AND deleted IS NULL
-                    LIMIT 1
-                """
-                params = (widget_id, self.account_id)
-                async with db.execute(query, params) as cursor:
-                    async for row in cursor:
-                        current = dict(zip(fields, row))
-            if current is None or prefix != "widget":
+            if widget_id is None or prefix != "widget":
                 errors['id'] = 'id must be an existing widget id'
-            else:
-                current['id'] = widget_code
-
-        if 'name' in post:
-            name = post["name"]
-            if current and name == current['name']:
-                pass
-            elif not name:
-                errors['name'] = 'name is required'
-            elif not isinstance(name, str):
-                errors['name'] = 'name must be a string'
-            elif 64 < len(name):
-                errors['name'] = 'name must not be longer than 64 characters'
-            else:
-                changes['name'] = name
-
-        if 'parts' in post:
-            parts = post["parts"]
-            if current and parts == current['parts']:
-                pass
-            elif not parts:
-                errors['parts'] = 'parts is required'
-            elif not isinstance(parts, int):
-                errors['parts'] = 'parts must be an integer'
-            elif parts < 0:
-                errors['parts'] = 'parts must not be negative'
-            elif (1 << 31) < parts:
-                errors['parts'] = 'parts must not be excessively large'
-            else:
-                changes['parts'] = parts
-
-        if 'description' in post:
-            description = post["description"]
-            if current and description == current['description']:
-                pass
-            elif description is not None and not isinstance(description, str):
-                errors['description'] = 'description must be a string'
-            else:
-                changes['description'] = description
+
+        changes, field_errors = check_fields(post, partial=True)
+        errors.update(field_errors)
 
         if errors:
             self.set_status(400)
             self.write({'error': errors})
             return
 
+        current = None
         if changes:
-            now = self.dbmanager.now()
-            selected = {'id': widget_id, 'account_id': self.account_id}
-            changes['updated'] = str(now)
-            await self.dbmanager.update('widgets', changes, **selected)
-            current.update(changes)
+            # Only write if something actually changed, since any write
+            # counts as a change to the account, even one that sets the
+            # same values again.
+            fields = list(changes)
+            values = tuple(changes.values())
+            differs = ' OR '.join(f'{field} IS NOT ?' for field in fields)
+            settings = [f'{field} = ?' for field in fields]
+            settings.append('updated = ?')
+            params = values + (self.dbmanager.now(),)
+            current = await self.update_widget(
+                widget_id, ', '.join(settings), params,
+                f"deleted IS NULL AND ({differs})", values)
+
+        changed = current is not None
+        if not changed:
+            current = await self.select_widget(widget_id, "deleted IS NULL")
+
+        if current is None:
+            self.set_status(400)
+            self.write({'error': {'id': 'id must be an existing widget id'}})
+            return
 
+        del current['deleted']
+        format_times(current)
+        current['id'] = widget_code
+        if changed:
+            publish_change(self, "update", current)
         self.write({
             'account': self.account_code,
             'widget': current,
@@ -218,42 +508,33 @@ class WidgetHandler(widgets.auth.AuthorizedRequestHandler):
         if not widget_code:
             errors['id'] = 'id is required'
         else:
-            # This could just go ahead with the delete and check for changes,
-            # but querying first is just a little easier in many systems.
             prefix, widget_id = await self.dbmanager.decode_id(widget_code)
-            current = None
-            async with self.dbmanager.connect() as db:
-                fields = ["name", "parts", "description", "created", "updated"]
-                query = f"""
-                    SELECT {', '.join(fields)}
-                    FROM widgets
-                    WHERE id = ? AND account_id = ? AND deleted IS NULL
-                    LIMIT 1
-                """
-                params = (widget_id, self.account_id)
-                async with db.execute(query, params) as cursor:
-                    async for row in cursor:
-                        current = dict(zip(fields, row))
-            if current is None or prefix != "widget":
+            if widget_id is None or prefix != "widget":
                 errors['id'] = 'id must be an existing widget id'
-            else:
-                current['id'] = widget_code
 
         if errors:
             self.set_status(400)
             self.write({'error': errors})
             return
 
-        changes = {'deleted': str(self.dbmanager.now())}
-        selected = {'id': widget_id, 'account_id': self.account_id}
-        changed = await self.dbmanager.update('widgets', changes, **selected)
-        current.update(changes)
+        params = (self.dbmanager.now(),)
+        current = await self.update_widget(widget_id, "deleted = ?",
+                                           params, "deleted IS NULL")
 
-        if not changed:
-            self.set_status(409)
-            self.write({'error': 'No changes made'})
+        if current is None:
+            if await self.select_widget(widget_id):
+                self.set_status(409)
+                self.write({'error': 'No changes made'})
+            else:
+                self.set_status(400)
+                self.write({'error': {
+                    'id': 'id must be an existing widget id',
+                }})
             return
 
+        format_times(current)
+        current['id'] = widget_code
+        publish_change(self, "delete", current)
         self.write({
             'account': self.account_code,
             'widget': current,
@@ -282,44 +563,326 @@ class WidgetHandler(widgets.auth.AuthorizedRequestHandler):
         if not widget_code:
             errors['id'] = 'id is required'
         else:
-            # This could just go ahead with the delete and check for changes,
-            # but querying first is just a little easier in many systems.
             prefix, widget_id = await self.dbmanager.decode_id(widget_code)
-            current = None
-            async with self.dbmanager.connect() as db:
-                fields = ["name", "parts", "description", "created"]
-                query = f"""
-                    SELECT {', '.join(fields)}
-                    FROM widgets
-                    WHERE id = ? AND account_id = ?
-                    AND deleted IS NOT NULL
-                    LIMIT 1
-                """
-                params = (widget_id, self.account_id)
-                async with db.execute(query, params) as cursor:
-                    async for row in cursor:
-                        current = dict(zip(fields, row))
-            if current is None or prefix != "widget":
+            if widget_id is None or prefix != "widget":
                 errors['id'] = 'id must be a deleted widget id'
-            else:
-                current['id'] = widget_code
 
         if errors:
             self.set_status(400)
             self.write({'error': errors})
             return
 
-        changes = {'deleted': None, 'updated': str(self.dbmanager.now())}
-        selected = {'id': widget_id, 'account_id': self.account_id}
-        changed = await self.dbmanager.update('widgets', changes, **selected)
-        current.update(changes)
+        params = (self.dbmanager.now(),)
+        current = await self.update_widget(widget_id,
+                                           "deleted = NULL, updated = ?",
+                                           params, "deleted IS NOT NULL")
 
-        if not changes:
-            self.set_status(409)
-            self.write({'error': 'No changes made'})
+        if current is None:
+            if await self.select_widget(widget_id):
+                self.set_status(409)
+                self.write({'error': 'No changes made'})
+            else:
+                self.set_status(400)
+                self.write({'error': {'id': 'id must be a deleted widget id'}})
             return
 
+        format_times(current)
+        current['id'] = widget_code
+        publish_change(self, "restore", current)
         self.write({
             'account': self.account_code,
             'widget': current,
         })
+
+    async def update_widget(self, widget_id, settings, params, condition,
+                            condition_params=()):
+        # Checks and changes the widget in a single statement, so nothing
+        # can sneak in between.  No row back means the condition failed.
+        fields = ["name", "parts", "description", "created", "updated",
+                  "deleted"]
+        query = f"""
+            UPDATE widgets SET {settings}
+            WHERE id = ? AND account_id = ? AND {condition}
+            RETURNING {', '.join(fields)}
+        """
+        params = (tuple(params) + (widget_id, self.account_id)
+                  + tuple(condition_params))
+        result = await self.dbmanager.write(query, params, fetch=True,
+                                            account_id=self.account_id)
+        if not result.rows:
+            return None
+
+        self.dbmanager.forget_listings(self.account_id)
+        return dict(zip(fields, result.rows[0]))
+
+    async def select_widget(self, widget_id, condition="1"):
+        fields = ["name", "parts", "description", "created", "updated",
+                  "deleted"]
+        current = None
+        async with self.dbmanager.connect(account_id=self.account_id) as db:
+            query = f"""
+                SELECT {', '.join(fields)}
+                FROM widgets
+                WHERE id = ? AND account_id = ? AND {condition}
+                LIMIT 1
+            """
+            params = (widget_id, self.account_id)
+            async with db.execute(query, params) as cursor:
+                async for row in cursor:
+                    current = dict(zip(fields, row))
+        return current
+
+
+class WidgetTotalsHandler(widgets.auth.AuthorizedRequestHandler):
+    # Reads the account's running totals, which triggers keep up to date,
+    # in a single lookup however many widgets there are.
+    async def get(self):
+        if not self.account_id:
+            self.set_status(401)
+            self.write({'error': 'Not Authorized'})
+            return
+
+        fields = ["widgets", "parts", "updated"]
+        totals = dict.fromkeys(fields, 0)
+        totals["updated"] = None
+        async with self.dbmanager.connect(account_id=self.account_id) as db:
+            query = f"""
+                SELECT {', '.join(fields)}
+                FROM account_totals
+                WHERE account_id = ?
+            """
+            async with db.execute(query, (self.account_id,)) as cursor:
+                async for row in cursor:
+                    totals = dict(zip(fields, row))
+
+        self.write({
+            'account': self.account_code,
+            'totals': format_times(totals),
+        })
+
+
+class WidgetBatchHandler(widgets.auth.AuthorizedRequestHandler):
+    # Applies a whole list of create, update, and delete operations in a
+    # single transaction.  If any of them fails, none of them take effect.
+    async def post(self):
+        if not self.account_id:
+            self.set_status(401)
+            self.write({'error': 'Not Authorized'})
+            return
+
+        try:
+            post = json.loads(self.request.body)
+        except Exception:
+            self.set_status(400)
+            self.write({'error': 'Invalid json request'})
+            return
+        if not isinstance(post, dict):
+            self.set_status(400)
+            self.write({'error': 'Invalid json request'})
+            return
+
+        operations = post.get("operations")
+        if not operations or not isinstance(operations, list):
+            error = 'operations must be a list of operations'
+        elif MAX_BATCH_OPERATIONS < len(operations):
+            error = (f'operations must not contain more than '
+                     f'{MAX_BATCH_OPERATIONS} operations')
+        else:
+            error = None
+        if error:
+            self.set_status(400)
+            self.write({'error': {'operations': error}})
+            return
+
+        # Decode every id in one go, rather than one operation at a time.
+        codes = set(
+            operation.get("id") for operation in operations
+            if isinstance(operation, dict)
+            and isinstance(operation.get("id"), str))
+        codes.discard("")
+        codes = list(codes)
+        widget_ids = await self.dbmanager.decode_ids("widget", codes)
+        decoded = dict(zip(codes, widget_ids))
+
+        errors = {}
+        results = []
+        selected = {}
+        for n, operation in enumerate(operations):
+            result, operation_errors = self.check_operation(operation,
+                                                            decoded)
+            widget_id = result.get("widget_id")
+            if widget_id in selected:
+                operation_errors['id'] = 'id must not appear more than once'
+            elif widget_id is not None:
+                selected[widget_id] = result
+            if operation_errors:
+                errors[n] = operation_errors
+            results.append(result)
+
+        if errors:
+            self.set_status(400)
+            self.write({'error': errors})
+            return
+
+        async with self.dbmanager.connect(write=True,
+                                          account_id=self.account_id) as db:
+            # Take the write lock up front, so nothing can change the
+            # selected widgets between reading and updating them.
+            await db.execute("BEGIN IMMEDIATE")
+            now = self.dbmanager.now()
+
+            current = await self.load_widgets(db, list(selected))
+            for n, result in enumerate(results):
+                widget_id = result.get("widget_id")
+                if widget_id is not None and widget_id not in current:
+                    errors[n] = {'id': 'id must be an existing widget id'}
+            if errors:
+                await db.rollback()
+                self.set_status(400)
+                self.write({'error': errors})
+                return
+
+            creates = [r for r in results if r["op"] == "create"]
+            if creates:
+                await self.create_widgets(db, creates, now)
+
+            updates = {}
+            deletes = []
+            for result in results:
+                if result["op"] == "update":
+                    widget = current[result["widget_id"]]
+                    changes = dict(
+                        (field, value)
+                        for field, value in result["changes"].items()
+                        if value != widget[field])
+                    if changes:
+                        changes["updated"] = now
+                        widget.update(changes)
+                        result["event"] = "update"
+                        params = (result["widget_id"], self.account_id)
+                        updates.setdefault(tuple(changes), []).append(
+                            tuple(changes.values()) + params)
+                    result["widget"] = widget
+                elif result["op"] == "delete":
+                    widget = current[result["widget_id"]]
+                    widget["deleted"] = now
+                    deletes.append((now, result["widget_id"],
+                                    self.account_id))
+                    result["widget"] = widget
+                    result["event"] = "delete"
+
+            # Group the updates by which fields they change, so each group
+            # can share one statement.
+            for fields, params in updates.items():
+                settings = ', '.join(f'{field} = ?' for field in fields)
+                query = f"""
+                    UPDATE widgets SET {settings}
+                    WHERE id = ? AND account_id = ?
+                """
+                await db.executemany(query, params)
+
+            if deletes:
+                query = """
+                    UPDATE widgets SET deleted = ?
+                    WHERE id = ? AND account_id = ?
+                """
+                await db.executemany(query, deletes)
+
+            await db.commit()
+        self.dbmanager.forget_listings(self.account_id)
+
+        widget_ids = [result.pop("widget_id") for result in results]
+        codes = await self.dbmanager.encode_ids("widget", widget_ids)
+        for result, code in zip(results, codes):
+            result.pop("changes", None)
+            format_times(result["widget"])
+            result["widget"]["id"] = code
+
+        for result in results:
+            event = result.pop("event", None)
+            if event:
+                publish_change(self, event, result["widget"])
+
+        self.write({
+            'account': self.account_code,
+            'results': results,
+        })
+
+    def check_operation(self, operation, decoded):
+        if not isinstance(operation, dict):
+            return {"op": None}, {'op': 'operation must be an object'}
+
+        op = operation.get("op")
+        result = {"op": op}
+        errors = {}
+        if op == "create":
+            result["changes"], errors = check_fields(operation)
+        elif op in ("update", "delete"):
+            widget_code = operation.get("id")
+            if not widget_code or not isinstance(widget_code, str):
+                errors['id'] = 'id is required'
+            else:
+                widget_id = decoded.get(widget_code)
+                if widget_id is None:
+                    errors['id'] = 'id must be an existing widget id'
+                else:
+                    result["widget_id"] = widget_id
+            if op == "update":
+                result["changes"], field_errors = check_fields(
+                    operation, partial=True)
+                errors.update(field_errors)
+        else:
+            errors['op'] = 'op must be create, update, or delete'
+        return result, errors
+
+    async def load_widgets(self, db, widget_ids):
+        fields = ["id", "name", "parts", "description", "created", "updated"]
+        current = {}
+        # Stay well under SQLite's limit on bound parameters.
+        for start in range(0, len(widget_ids), 500):
+            chunk = widget_ids[start:start + 500]
+            query = f"""
+                SELECT {', '.join(fields)}
+                FROM widgets
+                WHERE account_id = ? AND deleted IS NULL
+                AND id IN ({', '.join('?' for widget_id in chunk)})
+            """
+            params = [self.account_id] + chunk
+            async with db.execute(query, params) as cursor:
+                async for row in cursor:
+                    widget = dict(zip(fields, row))
+                    current[widget.pop("id")] = widget
+        return current
+
+    async def create_widgets(self, db, creates, now):
+        # With the write lock held, nothing else can take the ids after the
+        # next one, so they can all be handed out up front.
+        fields = ["name", "parts", "description"]
+        floor = await self.dbmanager.widget_id_floor()
+        database = self.dbmanager.database(self.account_id)
+        query = f"SELECT {database.widget_id_sql(floor)}"
+        async with db.execute(query) as cursor:
+            first_id = (await cursor.fetchone())[0]
+        widget_ids = [first_id + n * database.shards
+                      for n in range(len(creates))]
+
+        query = f"""
+            INSERT INTO widgets
+            (id, account_id, {', '.join(fields)}, created, updated)
+            VALUES (?, ?, {', '.join('?' for field in fields)}, ?, ?)
+        """
+        params = [
+            (widget_id, self.account_id)
+            + tuple(result["changes"][field] for field in fields)
+            + (now, now)
+            for widget_id, result in zip(widget_ids, creates)
+        ]
+        await db.executemany(query, params)
+
+        for result, widget_id in zip(creates, widget_ids):
+            widget = dict(result["changes"])
+            widget["created"] = now
+            widget["updated"] = now
+            result["widget_id"] = widget_id
+            result["widget"] = widget
+            result["event"] = "create"